@@ -1,5 +1,12 @@
 from .config import *
 from .metathesaurus import *
+from .graph import *
+from .type_index import *
+from .similarity import *
 from .semantic_network import *
 from .lf_factory import *
-from .dictionary import *
\ No newline at end of file
+from .dictionary import *
+from .term_store import *
+from .labeling import *
+from .label_store import *
+from .snapshot import *
\ No newline at end of file
@@ -1,6 +1,10 @@
 from collections import namedtuple
 
-DatabaseConfig = namedtuple("DatabaseConfig",["host","username","dbname","password"])
+# backend is one of mysql|postgres|sqlite. For sqlite, dbname is the path to
+# a snapshot file created by snapshot.build_snapshot
+DatabaseConfig = namedtuple("DatabaseConfig",["host","username","dbname",
+                                              "password","backend"])
+DatabaseConfig.__new__.__defaults__ = ("", "mysql")
 
 DEFAULT_UMLS_CONFIG = DatabaseConfig(host="127.0.0.1",
                                      username="umls",
@@ -13,9 +13,13 @@ import sys
 import glob
 import codecs
 import itertools
+import numpy as np
+from scipy.sparse import diags
 from functools import partial
 from collections import defaultdict
 from .metathesaurus import TextNorm
+from .term_store import DictionaryCache
+from .labeling import DictionaryLabeler, mention_span
 
 
 def dict_lf_factory(dictionary, rvalue, name, ignore_case=True):
@@ -35,11 +39,12 @@ def dict_lf_factory(dictionary, rvalue, name, ignore_case=True):
     return func_template
 
 
-class UmlsDict(object):
+class UmlsDict(DictionaryCache):
 
     def __init__(self, term_type, sem_types=[], 
                  source_vocabs=[], rootdir=None, 
-                 ignore_case=False, normalizer=TextNorm()):
+                 ignore_case=False, normalizer=TextNorm(), n_jobs=1,
+                 compiled=False):
         
         module_path = os.path.dirname(__file__)
         self.rootdir = rootdir if rootdir else "{}/data/cache/{}/".format(module_path,term_type)
@@ -49,98 +54,82 @@ class UmlsDict(object):
         self.source_vocabs = source_vocabs
         self.encoding = "utf-8"
         self.ignore_case = ignore_case
+        self.n_jobs = n_jobs
+        self.compiled = compiled
         self._dictionary = self._load_dictionaries()
         self.normalizer = normalizer
     
     def _norm_sty_name(self,s):
         return s.lower().replace(" ","_")
     
-    def _load_dictionaries(self):
+    @property
+    def normalizer(self):
+        return self._normalizer
+    
+    @normalizer.setter
+    def normalizer(self, normalizer):
+        '''Assigning a new normalizer invalidates all memoized dictionaries'''
+        self._normalizer = normalizer
+        self._normalized = None
+        self._memo = {}
+    
+    def _normalized_terms(self):
         '''
-        Load dictionaries
+        Normalized terms of each (sty,sab) dictionary, aligned with the 
+        raw terms. Computed once per normalizer. Any object with an apply()
+        method works as a normalizer; TextNorm's batch normalize_many is 
+        used when available.
         '''
-        d = defaultdict(defaultdict)
-        filelist = glob.glob("{}*.txt.bz2".format(self.rootdir))
-        
-        for fpath in filelist:
-            fname = fpath.split("/")[-1].rstrip(".txt.bz2")
-            i = fname.index(".")
-            sty,sab = fname[0:i], fname[i+1:].rstrip(".abbrv")
-            
-            #print sty,sab
-            
-            # only include specified semantic types and source vocabularies
-            if self.sem_types and sty not in self.sem_types:
-                continue
-            if self.source_vocabs and sab not in self.source_vocabs:
-                continue
-
-            terms = []
-            with bz2.BZ2File(fpath,"rb") as f:
-                for line in f:
-                    if not line.strip():
-                        continue
-                    try:
-                        line = line.strip().decode('utf-8')
-                        terms += [line.strip().lower() if self.ignore_case else line.strip()]
-                    except:
-                        print>>sys.stderr,"Warning: unicode conversion error"
-                    
-            if sty in d and sab in d[sty]:                        
-                d[sty][sab].update(dict.fromkeys(terms))
-            else:
-                d[sty][sab] = dict.fromkeys(terms)
-            
-        return d  
+        if self._normalized is None:
+            normalize_many = getattr(self.normalizer, "normalize_many", None)
+            if normalize_many is None:
+                normalize_many = lambda terms:[self.normalizer.apply(t) for t in terms]
+            d = defaultdict(dict)
+            for sty in self._dictionary:
+                for sab in self._dictionary[sty]:
+                    terms = normalize_many(self._dictionary[sty][sab])
+                    d[sty][sab] = [t.lower() for t in terms] if self.ignore_case else terms
+            self._normalized = d
+        return self._normalized
     
     def __iter__(self):
-        for sty in self._dictionary:
-            for sab in self._dictionary[sty]:
-                for term in self._dictionary[sty][sab]:
-                    t = self.normalizer.apply(term)
-                    
-                    yield t.lower() if self.ignore_case else t
+        normalized = self._normalized_terms()
+        for sty in normalized:
+            for sab in normalized[sty]:
+                for t in normalized[sty][sab]:
+                    yield t
     
     
     def __getitem__(self,key):
         '''
+        Normalized dictionary of a semantic type, collapsed over source 
+        vocabularies. Memoized and shared between callers, so treat it as 
+        read-only (copy it with dict() to modify it).
         '''
-        d = {}
         key = self._norm_sty_name(key)
-        # collapse into single dictionary by semantic type
-        for sab in self._dictionary[key]:
-            d.update(self._dictionary[key][sab])
-            
-        # apply normalization
-        d = {self.normalizer.apply(term).lower() if self.ignore_case else self.normalizer.apply(term):1 for term in d}
-        return d
+        if ("sty",key) not in self._memo:
+            normalized = self._normalized_terms()[key]
+            self._memo[("sty",key)] = dict.fromkeys(itertools.chain.from_iterable(
+                                                    normalized.values()), 1)
+        return self._memo[("sty",key)]
 
   
     def get_dictionary(self, sem_types=[]):
         '''
-        Collapse into single dictionary
+        Collapse into single dictionary. Memoized and shared, so treat it
+        as read-only (see __getitem__).
         '''
-        d = []
-        sem_types = [self._norm_sty_name(s) for s in sem_types]
-        
-        for sty in self._dictionary:
-            if sem_types and sty not in sem_types:
-                continue
-            for sab in self._dictionary[sty]:
-                d += self._dictionary[sty][sab].keys()
-        
-        d = [self.normalizer.apply(term).lower() if self.ignore_case else \
-             self.normalizer.apply(term) for term in d]
-        
-        return dict.fromkeys(d)
+        sem_types = frozenset([self._norm_sty_name(s) for s in sem_types])
+        if ("collapsed",sem_types) not in self._memo:
+            normalized = self._normalized_terms()
+            d = [normalized[sty][sab] for sty in normalized for sab in normalized[sty]
+                 if not sem_types or sty in sem_types]
+            self._memo[("collapsed",sem_types)] = dict.fromkeys(itertools.chain.from_iterable(d))
+        return self._memo[("collapsed",sem_types)]
   
   
-    def get_lfs(self, rvalue_default, sem_types=[], 
-                rvalue_map={}, min_size=1):
-        ''' 
-        Given a dictionary of dictionaries from the UMLS,
-        create a set of labeling functions. 
-        '''
+    def _lf_specs(self, rvalue_default, sem_types=[], rvalue_map={}, min_size=1):
+        '''(name, (sty,sab), rvalue) of each labeling function'''
         sem_types = [self._norm_sty_name(s) for s in sem_types]
         
         for sty in self._dictionary:
@@ -155,17 +144,35 @@ class UmlsDict(object):
                 label = "pos" if rvalue == 1 else "neg"
                 prefix = "{}_".format(self.term_type) if self.term_type else ""
                 func_name = "LF_{}{}_{}_{}".format(prefix,sty,sab,label)
+                yield func_name, (sty,sab), rvalue
     
-                yield dict_lf_factory(self._dictionary[sty][sab], rvalue,
-                                      func_name, self.ignore_case)
+    def get_lfs(self, rvalue_default, sem_types=[], 
+                rvalue_map={}, min_size=1):
+        ''' 
+        Given a dictionary of dictionaries from the UMLS,
+        create a set of labeling functions. 
+        '''
+        for func_name, (sty,sab), rvalue in self._lf_specs(rvalue_default, sem_types,
+                                                          rvalue_map, min_size):
+            yield dict_lf_factory(self._lf_dictionary(sty, sab), rvalue, func_name,
+                                  self.ignore_case)
+    
+    def labeler(self, rvalue_default, sem_types=[], rvalue_map={}, min_size=1):
+        '''
+        Fused evaluator of the same labeling functions as get_lfs(),
+        producing a sparse label matrix in one pass
+        '''
+        lfs = list(self._lf_specs(rvalue_default, sem_types, rvalue_map, min_size))
+        return DictionaryLabeler(self.store, lfs, mention_span, self.ignore_case)
 
 
 # OLD
 
-class UmlsDictionary(object):
+class UmlsDictionary(DictionaryCache):
 
     def __init__(self, term_type="*", sem_types=[], 
-                 source_vocabs=[], rootdir=None, ignore_case=False):
+                 source_vocabs=[], rootdir=None, ignore_case=False,
+                 n_jobs=1, compiled=False):
         '''UMLS dictionary
         
         Load cached dictionary files broken down by semantic type (sty), 
@@ -188,6 +195,15 @@ class UmlsDictionary(object):
         ignore_case : boolean, optional
             Lowercase all text if True, default = False
         
+        n_jobs : int, optional
+            Processes used to decode cache files. Default is 1 (no process 
+            pool), None for one per core.
+        
+        compiled : boolean, optional
+            Use the compiled TermStore of rootdir if there is an up to date
+            one (see term_store.compile_dictionaries). Dictionaries are then
+            read-only TermSet views instead of dicts. Default = False
+        
         Attributes
         ----------
         
@@ -204,7 +220,8 @@ class UmlsDictionary(object):
         self.source_vocabs = source_vocabs
         self.encoding = "utf-8"
         self.ignore_case = ignore_case
-        
+        self.n_jobs = n_jobs
+        self.compiled = compiled
         self._dictionary = self._load_dictionaries()
 
         
@@ -212,65 +229,71 @@ class UmlsDictionary(object):
         return s.lower().replace(" ","_")
     
 
-    def _load_dictionaries(self):
-        '''Load dictionaries'''
-        d = defaultdict(defaultdict)
-        filelist = glob.glob("{}*.txt.bz2".format(self.rootdir))
-        
-        for fpath in filelist:
-            fname = fpath.split("/")[-1].rstrip(".txt.bz2")
-            i = fname.index(".")
-            sty,sab = fname[0:i], fname[i+1:].rstrip(".abbrv")
-            
-            # only include specified semantic types and source vocabularies
-            if self.sem_types and sty not in self.sem_types:
-                continue
-            if self.source_vocabs and sab not in self.source_vocabs:
-                continue
-
-            terms = []
-            with bz2.BZ2File(fpath,"rb") as f:
-                for line in f:
-                    if not line.strip():
-                        continue
-                    try:
-                        line = line.strip().decode('utf-8')
-                        terms += [line.strip().lower() if self.ignore_case else line.strip()]
-                    except:
-                        print>>sys.stderr,"Warning: unicode conversion error"
-                        
-            if sty in d and sab in d[sty]:    
-                d[sty][sab].update(dict.fromkeys(terms))
-            else:
-                d[sty][sab] = dict.fromkeys(terms)
-            
-        return d    
-    
-    
     def get_sem_types(self,term):
-        '''Return all matching semantic types for this term '''
+        '''Return all matching semantic types for this term (one inverted
+        index probe)'''
         stys = {}
-        for sty in self._dictionary:
-            for sab in self._dictionary[sty]:
-                if term in self._dictionary[sty][sab]:
-                    stys[sty] = stys.get(sty,0) + 1    
+        for sty,sab in self.store.dictionaries_of(term):
+            if sty in self._dictionary and sab in self._dictionary[sty]:
+                stys[sty] = stys.get(sty,0) + 1    
         return stys
     
     
+    def sem_type_matrix(self,terms):
+        '''Batch get_sem_types. Returns a sparse len(terms) x semantic type
+        count matrix and its column semantic types'''
+        keys = [(sty,sab) for sty in self._dictionary for sab in self._dictionary[sty]]
+        return self.store.type_matrix(terms, keys)
+    
+    
     def coverage(self,terms,ignore_case=True):
         '''Score a list of terms by source dictionary coverage. We're
         not doing a set cover optimization, just returning a ranked list
-        of percent covered by dictionary sty/sab'''
-        scores = {}
+        of percent covered by dictionary sty/sab (see source_coverage)'''
+        stats = self.source_coverage(terms, ignore_case)
+        scores = [(key,score) for key,score in zip(stats["sources"], stats["coverage"]) 
+                  if score > 0]
+        return sorted(scores,key=lambda x:x[1], reverse=1)
+    
+    
+    def source_coverage(self,terms,ignore_case=True):
+        '''Coverage statistics of a list of terms over every (sty,sab) 
+        dictionary, computed from a sparse term x source matrix. Repeated 
+        terms count once per occurrence.
+        
+        Returns
+        -------
+        dict with
+            sources   (sty,sab) of each column
+            coverage  fraction of terms found in each source
+            overlap   sparse source x source matrix of shared term counts
+            greedy    greedy set cover ranking, a list of ((sty,sab), 
+                      marginal coverage, cumulative coverage)
+        '''
         terms = [t.lower() if ignore_case else t for t in terms]
-        for sty in self._dictionary:
-            for sab in self._dictionary[sty]:
-                #dictionary = [t.lower() if ignore_case else t for t in self._dictionary[sty][sab]]
-                dictionary = self._dictionary[sty][sab]
-                intersection = sum([1 for t in terms if t in dictionary])
-                if intersection > 0:
-                    scores[(sty,sab)] = intersection / float(len(terms))  
-        return sorted(scores.items(),key=lambda x:x[1], reverse=1)
+        sources = sorted((sty,sab) for sty in self._dictionary for sab in self._dictionary[sty])
+        
+        # map terms to ids once, weight each distinct term by its frequency
+        ids, weights = np.unique(self.store.term_ids(terms), return_counts=True)
+        weights = np.where(ids >= 0, weights, 0).astype(np.float64)
+        matrix = self.store.membership_matrix(ids, sources).astype(np.float64).tocsc()
+        n = float(max(len(terms), 1))
+        
+        coverage = matrix.T.dot(weights) / n
+        overlap = (matrix.T * diags(weights) * matrix).tocsr()
+        
+        greedy, covered, remaining = [], 0.0, weights.copy()
+        while True:
+            gains = matrix.T.dot(remaining)
+            best = int(np.argmax(gains)) if len(gains) else 0
+            if not len(gains) or gains[best] <= 0:
+                break
+            covered += gains[best]
+            greedy.append((sources[best], gains[best] / n, covered / n))
+            remaining[matrix.indices[matrix.indptr[best]:matrix.indptr[best + 1]]] = 0
+        
+        return {"sources":sources, "coverage":coverage, "overlap":overlap,
+                "greedy":greedy}
                         
                              
     def get_dictionary(self):
@@ -0,0 +1,512 @@
+'''
+Compact Concept Graph
+
+Directed concept graph stored as CSR adjacency arrays. Node names (CUIs
+or AUIs) are interned as a sorted fixed-width string array, so a node's
+integer id is its position in that array, and relation types (REL) and
+attributes (RELA) are stored as small integer codes per edge. A full
+MRREL hierarchy fits in a few hundred MB instead of many GB as a
+networkx.DiGraph.
+
+ClosureIndex adds a precomputed reachability (ancestor/descendant)
+index over a ConceptGraph.
+
+'''
+import os
+import json
+import numpy as np
+import networkx as nx
+from array import array
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+
+
+def lookup(names, query):
+    '''Vectorized lookup of query names in a sorted name array. Returns
+    positions, -1 for unknown names.'''
+    query = np.asarray(query, dtype=names.dtype)
+    idx = np.searchsorted(names, query)
+    idx[idx >= len(names)] = 0
+    found = (names[idx] == query) if len(names) else np.zeros(len(query), bool)
+    return np.where(found, idx, -1)
+
+
+class ConceptGraph(object):
+    '''Directed graph with CSR (compressed sparse row) adjacency.
+
+    Attributes
+    ----------
+    nodes : array
+        Sorted node names. Node ids are positions in this array.
+
+    indptr, indices : array
+        Out-edges of node i are indices[indptr[i]:indptr[i+1]]
+
+    rel, rela : array
+        Per-edge codes into rel_names and rela_names
+
+    '''
+    def __init__(self, nodes, indptr, indices, rel, rela,
+                 rel_names, rela_names):
+        self.nodes = nodes
+        self.indptr = indptr
+        self.indices = indices
+        self.rel = rel
+        self.rela = rela
+        self.rel_names = rel_names
+        self.rela_names = rela_names
+        self._reverse = None
+        self._closure = None
+        self._edge_keys = None
+        self._sources = None
+        self._rela_groups = None
+
+    @classmethod
+    def from_edges(cls, edges, collapse=True):
+        '''Build from an iterable of (parent, child, rel, rela) rows (e.g. a
+        streamed MRREL query). By default repeated (parent, child) pairs are
+        collapsed and keep the last rel/rela, like networkx.DiGraph.add_edge.
+        Set collapse=False to keep every distinct (rel, rela) of a pair.'''
+        ids, names = {}, []
+        rel_codes, rela_codes = {}, {}
+        src, dst, rel, rela = array('l'), array('l'), array('B'), array('H')
+
+        def intern(name, table, names=None):
+            if name not in table:
+                table[name] = len(table)
+                if names is not None:
+                    names.append(name)
+            return table[name]
+
+        for parent, child, r, ra in edges:
+            src.append(intern(parent, ids, names))
+            dst.append(intern(child, ids, names))
+            rel.append(intern(r, rel_codes))
+            rela.append(intern(ra, rela_codes))
+
+        # sort node names so lookups are a binary search
+        names = np.array(names, dtype=str) if names else np.array([], dtype="S1")
+        order = np.argsort(names, kind="mergesort")
+        rank = np.empty(len(names), dtype=np.int64)
+        rank[order] = np.arange(len(names))
+        src = rank[np.array(src, dtype=np.int64)]
+        dst = rank[np.array(dst, dtype=np.int64)]
+        rel = np.array(rel, dtype=np.uint8)
+        rela = np.array(rela, dtype=np.uint16)
+
+        n = len(names)
+        if collapse:
+            # collapse duplicate edges, keeping the last occurrence
+            keys = (src * n + dst)[::-1]
+            keys, first = np.unique(keys, return_index=True)
+            last = len(src) - 1 - first
+            src, dst = keys // max(n,1), keys % max(n,1)
+            rel, rela = rel[last], rela[last]
+        else:
+            # drop exact duplicates (e.g. the same relation from several SABs)
+            last = np.lexsort((rela, rel, dst, src))
+            src, dst, rel, rela = src[last], dst[last], rel[last], rela[last]
+            distinct = np.ones(len(src), dtype=bool)
+            distinct[1:] = (np.diff(src) != 0) | (np.diff(dst) != 0) | \
+                           (np.diff(rel) != 0) | (np.diff(rela) != 0)
+            src, dst, rel, rela = src[distinct], dst[distinct], rel[distinct], rela[distinct]
+
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=n), out=indptr[1:])
+
+        decode = lambda table: [k for k,v in sorted(table.items(), key=lambda x:x[1])]
+        return cls(names[order], indptr, dst.astype(np.int32), rel, rela,
+                   decode(rel_codes), decode(rela_codes))
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, node):
+        return self.index(node) is not None
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+    def number_of_edges(self):
+        return len(self.indices)
+
+    def index(self, node):
+        '''Integer id of node or None'''
+        i = self.indices_of([node])[0]
+        return i if i >= 0 else None
+
+    def indices_of(self, nodes):
+        '''Vectorized node name to id lookup, -1 for unknown nodes'''
+        return lookup(self.nodes, nodes)
+
+    def _adjacency(self, reverse=False):
+        '''CSR arrays (indptr, indices, edge ids) for out-edges, or in-edges
+        if reverse is set. The transpose is built on first use.'''
+        if not reverse:
+            return self.indptr, self.indices, None
+        if self._reverse is None:
+            n = len(self.nodes)
+            src = np.repeat(np.arange(n, dtype=np.int32), np.diff(self.indptr))
+            order = np.argsort(self.indices, kind="mergesort")
+            indptr = np.zeros(n + 1, dtype=np.int64)
+            np.cumsum(np.bincount(self.indices, minlength=n), out=indptr[1:])
+            self._reverse = (indptr, src[order], order)
+        return self._reverse
+
+    def _neighbors(self, i, reverse=False):
+        indptr, indices, _ = self._adjacency(reverse)
+        return indices[indptr[i]:indptr[i + 1]]
+
+    def successors(self, node):
+        i = self.index(node)
+        return [] if i is None else list(self.nodes[self._neighbors(i)])
+
+    def predecessors(self, node):
+        i = self.index(node)
+        return [] if i is None else list(self.nodes[self._neighbors(i, True)])
+
+    def out_edges(self, node):
+        '''(node, child, rel, rela) tuples'''
+        i = self.index(node)
+        if i is None:
+            return []
+        start, end = self.indptr[i], self.indptr[i + 1]
+        return [(node, self.nodes[j], self.rel_names[r], self.rela_names[ra]) for j,r,ra in
+                zip(self.indices[start:end], self.rel[start:end], self.rela[start:end])]
+
+    def edges_between(self, pairs):
+        '''Batched pair lookup. Edge (src, dst) keys are sorted, so each
+        (a, b) pair is two binary searches. Returns a list with the
+        (rel, rela) of every a -> b edge for each pair.'''
+        n = len(self.nodes)
+        if not len(pairs) or not n:
+            return [[] for pair in pairs]
+        if self._edge_keys is None:
+            self._edge_keys = self.edge_sources().astype(np.int64) * n + self.indices
+        idx = self.indices_of(np.asarray(pairs).ravel()).reshape(-1, 2)
+        keys = idx[:,0].astype(np.int64) * n + idx[:,1]
+        start = np.searchsorted(self._edge_keys, keys, side="left")
+        end = np.searchsorted(self._edge_keys, keys, side="right")
+        end[(idx < 0).any(axis=1)] = 0
+        return [[(self.rel_names[self.rel[k]], self.rela_names[self.rela[k]])
+                 for k in range(i, j)] for i, j in zip(start, end)]
+
+    def edge_sources(self):
+        '''Source node id of every edge (aligned with indices)'''
+        if self._sources is None:
+            self._sources = np.repeat(np.arange(len(self.nodes), dtype=self.indices.dtype),
+                                      np.diff(self.indptr))
+        return self._sources
+
+    def edges_by_rela(self, relas):
+        '''Ids of all edges with one of the given RELA values. Edges are
+        grouped by RELA code once, so each lookup is a slice per RELA.'''
+        if self._rela_groups is None:
+            order = np.argsort(self.rela, kind="mergesort")
+            counts = np.bincount(self.rela, minlength=len(self.rela_names))
+            self._rela_groups = (np.concatenate([[0], np.cumsum(counts)]), order)
+        ptr, order = self._rela_groups
+        relas = set([relas] if isinstance(relas, basestring) or relas is None else relas)
+        groups = [order[ptr[i]:ptr[i + 1]] for i, name in enumerate(self.rela_names)
+                  if name in relas]
+        return np.concatenate(groups) if groups else np.array([], dtype=np.int64)
+
+    def bfs_levels(self, sources, reverse=False, depth_limit=None):
+        '''Breadth-first search from node ids. Yields one array of newly
+        reached node ids per level, starting with the sources.'''
+        indptr, indices, _ = self._adjacency(reverse)
+        visited = np.zeros(len(self.nodes), dtype=bool)
+        frontier = np.unique(np.asarray(sources, dtype=np.int64))
+        visited[frontier] = True
+        depth = 0
+        while frontier.size:
+            yield frontier
+            if depth_limit is not None and depth >= depth_limit:
+                break
+            starts = indptr[frontier]
+            lengths = indptr[frontier + 1] - starts
+            total = lengths.sum()
+            if total == 0:
+                break
+            # gather all neighbors of the frontier in one vectorized step
+            offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+            nbrs = indices[offsets + np.arange(total)]
+            frontier = np.unique(nbrs[~visited[nbrs]])
+            visited[frontier] = True
+            depth += 1
+
+    def bfs(self, node, reverse=False, depth_limit=None):
+        '''Nodes reachable from node (including itself) in breadth-first
+        order. Set reverse to follow edges backwards (i.e. ancestors).'''
+        i = self.index(node)
+        if i is None:
+            return []
+        levels = list(self.bfs_levels([i], reverse, depth_limit))
+        return list(self.nodes[np.concatenate(levels)])
+
+    def to_networkx(self):
+        '''Convert to a networkx.DiGraph with rel and attribute edge data'''
+        G = nx.DiGraph()
+        G.add_nodes_from(self.nodes)
+        src = np.repeat(np.arange(len(self.nodes)), np.diff(self.indptr))
+        for i,j,r,ra in zip(src, self.indices, self.rel, self.rela):
+            G.add_edge(self.nodes[i], self.nodes[j], rel=self.rel_names[r],
+                       attribute=self.rela_names[ra])
+        return G
+
+    def closure(self):
+        '''Reachability index over this graph, built on first use'''
+        if self._closure is None:
+            self._closure = ClosureIndex.build(self)
+        return self._closure
+
+    def save(self, dirname):
+        '''Write arrays as .npy files (loadable with mmap_mode). The closure
+        index is saved alongside the graph if it has been built.'''
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        for name in ["nodes","indptr","indices","rel","rela"]:
+            np.save(os.path.join(dirname, "{}.npy".format(name)), getattr(self, name))
+        with open(os.path.join(dirname, "codes.json"), "w") as f:
+            json.dump({"rel":self.rel_names, "rela":self.rela_names}, f)
+        if self._closure is not None:
+            self._closure.save(dirname)
+
+    @classmethod
+    def load(cls, dirname, mmap_mode=None):
+        arrays = [np.load(os.path.join(dirname, "{}.npy".format(name)), mmap_mode=mmap_mode)
+                  for name in ["nodes","indptr","indices","rel","rela"]]
+        with open(os.path.join(dirname, "codes.json"), "r") as f:
+            codes = json.load(f)
+        graph = cls(*(arrays + [codes["rel"], codes["rela"]]))
+        if ClosureIndex.exists(dirname):
+            graph._closure = ClosureIndex.load(dirname, graph, mmap_mode)
+        return graph
+
+
+class ClosureIndex(object):
+    '''Reachability index using interval labels (Agrawal et al. 1989).
+
+    Cycles are first collapsed into strongly connected components. Each
+    component gets a post-order number from a DFS spanning forest, so a
+    tree subtree is one contiguous [low, post] interval. Multi-parent
+    (non-tree) edges are handled by giving each component the merged
+    intervals of all its children. b is reachable from a iff post(b)
+    falls in one of a's intervals, which is a binary search over a
+    handful of intervals.
+    '''
+    ARRAYS = ["component","post","iptr","ilo","ihi"]
+
+    def __init__(self, graph, component, post, iptr, ilo, ihi):
+        self.graph = graph
+        self.component = component
+        self.post = post
+        self.iptr = iptr
+        self.ilo = ilo
+        self.ihi = ihi
+        self._members = None
+        self._by_post = None
+        self._owner = None
+        self._stab = None
+
+    @classmethod
+    def build(cls, graph):
+        n = len(graph)
+        A = csr_matrix((np.ones(len(graph.indices), dtype=np.int8), graph.indices,
+                        graph.indptr), shape=(n, n))
+        ncomp, component = connected_components(A, directed=True, connection="strong")
+
+        # condensed DAG over strongly connected components (int64, so the
+        # src * ncomp + dst pair keys cannot overflow)
+        component = component.astype(np.int64)
+        src = component[np.repeat(np.arange(n), np.diff(graph.indptr))]
+        dst = component[graph.indices]
+        keys = np.unique((src * ncomp + dst)[src != dst])
+        src, dst = keys // max(ncomp,1), keys % max(ncomp,1)
+        indptr = np.zeros(ncomp + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=ncomp), out=indptr[1:])
+
+        # DFS spanning forest from root components; post-order numbers of a
+        # subtree are the contiguous range [low, post]
+        post = np.full(ncomp, -1, dtype=np.int64)
+        low = np.zeros(ncomp, dtype=np.int64)
+        visited = np.zeros(ncomp, dtype=bool)
+        roots = np.where(np.bincount(dst, minlength=ncomp) == 0)[0]
+        counter = 0
+        for root in roots:
+            visited[root] = True
+            low[root] = counter
+            stack = [[root, indptr[root]]]
+            while stack:
+                v, k = stack[-1]
+                if k < indptr[v + 1]:
+                    stack[-1][1] += 1
+                    w = dst[k]
+                    if not visited[w]:
+                        visited[w] = True
+                        low[w] = counter
+                        stack.append([w, indptr[w]])
+                else:
+                    stack.pop()
+                    post[v] = counter
+                    counter += 1
+
+        # children finish before parents, so propagate intervals in post order
+        intervals = [None] * ncomp
+        for v in np.argsort(post):
+            merged = [(low[v], post[v])]
+            for w in dst[indptr[v]:indptr[v + 1]]:
+                # skip plain tree subtrees, they're already covered
+                if len(intervals[w]) == 1 and low[v] <= intervals[w][0][0] \
+                   and intervals[w][0][1] <= post[v]:
+                    continue
+                merged.extend(intervals[w])
+            intervals[v] = cls._merge(merged)
+
+        iptr = np.zeros(ncomp + 1, dtype=np.int64)
+        np.cumsum([len(x) for x in intervals], out=iptr[1:])
+        flat = np.array([x for ivals in intervals for x in ivals],
+                        dtype=np.int64).reshape(-1, 2)
+        return cls(graph, component.astype(np.int32), post, iptr, flat[:,0], flat[:,1])
+
+    @staticmethod
+    def _merge(intervals):
+        intervals = sorted(intervals)
+        merged = [intervals[0]]
+        for lo, hi in intervals[1:]:
+            if lo <= merged[-1][1] + 1:
+                if hi > merged[-1][1]:
+                    merged[-1] = (merged[-1][0], hi)
+            else:
+                merged.append((lo, hi))
+        return merged
+
+    def _reachable(self, c1, c2):
+        '''Is component c2 reachable from component c1'''
+        start, end = self.iptr[c1], self.iptr[c1 + 1]
+        p = self.post[c2]
+        j = np.searchsorted(self.ilo[start:end], p, side="right") - 1
+        return j >= 0 and self.ihi[start + j] >= p
+
+    def _components(self, nodes):
+        idx = self.graph.indices_of(nodes)
+        if np.any(idx < 0):
+            raise KeyError("Unknown node(s): {}".format(np.asarray(nodes)[idx < 0]))
+        return self.component[idx]
+
+    def _expand(self, components):
+        '''Node names of a set of components'''
+        if self._members is None:
+            order = np.argsort(self.component, kind="mergesort")
+            mptr = np.zeros(len(self.post) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(self.component, minlength=len(self.post)), out=mptr[1:])
+            self._members = (mptr, order)
+        mptr, order = self._members
+        idx = [order[mptr[c]:mptr[c + 1]] for c in components]
+        return self.graph.nodes[np.concatenate(idx)] if idx else []
+
+    def is_ancestor(self, a, b):
+        '''True if b is reachable from a (a != b)'''
+        if a == b:
+            return False
+        c1, c2 = self._components([a, b])
+        return bool(self._reachable(c1, c2))
+
+    def descendant_components(self, c):
+        '''Components reachable from component c (including c)'''
+        if self._by_post is None:
+            self._by_post = np.argsort(self.post)
+        start, end = self.iptr[c], self.iptr[c + 1]
+        return np.concatenate([self._by_post[lo:hi + 1] for lo, hi in
+                               zip(self.ilo[start:end], self.ihi[start:end])])
+
+    def _owners(self):
+        '''Component owning each interval'''
+        if self._owner is None:
+            self._owner = np.repeat(np.arange(len(self.post)), np.diff(self.iptr))
+        return self._owner
+
+    def _stabbing_index(self):
+        '''Intervals sorted by low end, and a max-of-high-end tree over
+        them (implicit binary heap, leaf i is the i-th interval)'''
+        if self._stab is None:
+            order = np.argsort(self.ilo, kind="mergesort")
+            size = 1
+            while size < len(order):
+                size *= 2
+            tree = np.full(2 * size, -1, dtype=np.int64)
+            tree[size:size + len(order)] = self.ihi[order]
+            k = size
+            while k > 1:
+                tree[k // 2:k] = np.maximum(tree[k:2 * k:2], tree[k + 1:2 * k:2])
+                k //= 2
+            self._stab = (order, self.ilo[order], size, tree)
+        return self._stab
+
+    def ancestor_components(self, c):
+        '''Components that reach component c (including c). Intervals 
+        containing post(c) start at or before it (a binary search over the
+        sorted low ends), and the max tree prunes every subtree ending 
+        before it, so a query costs O(log I + k log I) for k hits.'''
+        order, lo, size, tree = self._stabbing_index()
+        p = self.post[c]
+        end = np.searchsorted(lo, p, side="right")
+        nodes, span = np.array([1], dtype=np.int64), size
+        while True:
+            start = (nodes - size // span) * span
+            nodes = nodes[(tree[nodes] >= p) & (start < end)]
+            if span == 1:
+                break
+            nodes = np.concatenate([2 * nodes, 2 * nodes + 1])
+            span //= 2
+        return np.unique(self._owners()[order[nodes - size]])
+
+    def ancestor_matrix(self, components):
+        '''Batched ancestor lookup. Returns a sparse boolean matrix with one
+        row per query component and a column for every component that
+        reaches it (including itself).'''
+        components = np.asarray(components, dtype=np.int64)
+        # stab every interval with the sorted query post numbers at once
+        posts = self.post[components]
+        order = np.argsort(posts, kind="mergesort")
+        posts = posts[order]
+        start = np.searchsorted(posts, self.ilo, side="left")
+        lengths = np.searchsorted(posts, self.ihi, side="right") - start
+        total = lengths.sum()
+        offsets = np.repeat(start - np.cumsum(lengths) + lengths, lengths)
+        rows = order[offsets + np.arange(total)]
+        cols = np.repeat(self._owners(), lengths)
+        return csr_matrix((np.ones(total, dtype=bool), (rows, cols)),
+                          shape=(len(components), len(self.post)))
+
+    def descendants(self, a):
+        c = self._components([a])[0]
+        return [x for x in self._expand(self.descendant_components(c)) if x != a]
+
+    def ancestors(self, a):
+        c = self._components([a])[0]
+        return [x for x in self._expand(self.ancestor_components(c)) if x != a]
+
+    def lowest_common_ancestors(self, a, b):
+        '''Common ancestors of a and b (including a and b themselves) that
+        have no descendant which is also a common ancestor'''
+        c1, c2 = self._components([a, b])
+        common = np.intersect1d(self.ancestor_components(c1),
+                                self.ancestor_components(c2))
+        lowest = [c for c in common if not any(self._reachable(c, d)
+                  for d in common if d != c)]
+        return list(self._expand(lowest))
+
+    @staticmethod
+    def exists(dirname):
+        return os.path.exists(os.path.join(dirname, "closure.post.npy"))
+
+    def save(self, dirname):
+        for name in self.ARRAYS:
+            np.save(os.path.join(dirname, "closure.{}.npy".format(name)), getattr(self, name))
+
+    @classmethod
+    def load(cls, dirname, graph, mmap_mode=None):
+        arrays = [np.load(os.path.join(dirname, "closure.{}.npy".format(name)), mmap_mode=mmap_mode)
+                  for name in cls.ARRAYS]
+        return cls(graph, *arrays)
@@ -0,0 +1,202 @@
+'''
+Label Matrix Store
+
+Persistent, column-oriented cache of dictionary label matrices. Adding a
+UMLS source or changing UmlsNoiseAwareDict's rm_sab only adds or changes
+some labeling functions, and new documents only add candidates, so most
+(LF, candidate) cells of the next label matrix have been computed before.
+LabelStore keeps every cell it has computed and only evaluates the rest.
+
+Store directory layout:
+
+    index.json            {lf name: {"checksum", "file"}} of each column
+    candidates.npy        candidate ids; a candidate's row is its position
+    <file>.rows.npy       sorted rows with a non-zero vote
+    <file>.values.npy     votes of those rows
+    <file>.computed.npy   packed bits, set for every row the LF was applied to
+
+Column files are named by the SHA-1 of the LF name (LF names may contain
+characters that are not safe in file names). Columns are keyed by LF name
+and DictionaryLabeler.checksum, a SHA-1 digest of the LF's dictionary 
+terms, vote and mention key, so a column whose dictionary or settings
+changed is recomputed from scratch, while LFs dropped or added (e.g. by
+rm_sab) leave the other columns as they are. Stored arrays are loaded
+memory-mapped.
+
+Usage:
+
+    store = LabelStore("labels/")
+    L = store.label_matrix(candidates, d.labeler(), n_jobs=4)
+
+'''
+import os
+import json
+import hashlib
+import numpy as np
+from scipy.sparse import csr_matrix
+from collections import defaultdict
+from .labeling import apply_lfs
+
+
+class LabelStore(object):
+    '''Label matrix columns persisted in dirname (created if missing)'''
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self._index = {}
+        path = os.path.join(dirname, "index.json")
+        if os.path.exists(path):
+            with open(path, "rU") as f:
+                self._index = json.load(f)
+        self.candidate_ids = self._load("candidates", np.int64)
+
+    def _path(self, name):
+        return os.path.join(self.dirname, "{}.npy".format(name))
+
+    def _load(self, name, dtype):
+        path = self._path(name)
+        if not os.path.exists(path):
+            return np.array([], dtype=dtype)
+        return np.load(path, mmap_mode="r")
+
+    def _save(self, name, array):
+        # write then rename, so memory-mapped readers keep the old file
+        tmpname = "{}.tmp".format(name)
+        np.save(self._path(tmpname), array)
+        os.rename(self._path(tmpname), self._path(name))
+
+    def _save_index(self):
+        path = os.path.join(self.dirname, "index.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(self._index, f)
+        os.rename(path + ".tmp", path)
+
+    def __len__(self):
+        return len(self.candidate_ids)
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def checksum(self, name):
+        '''Checksum of a stored column, or None'''
+        return self._index[name]["checksum"] if name in self._index else None
+
+    def _file(self, name):
+        '''File name prefix of a column'''
+        if name in self._index:
+            return self._index[name]["file"]
+        name = name.encode("utf-8") if isinstance(name, unicode) else name
+        return hashlib.sha1(name).hexdigest()
+
+    def _lookup(self, ids):
+        rows = np.full(len(ids), -1, dtype=np.int64)
+        if len(self.candidate_ids) == 0:
+            return rows
+        order = np.argsort(self.candidate_ids, kind="mergesort")
+        known = self.candidate_ids[order]
+        pos = np.minimum(np.searchsorted(known, ids), len(known) - 1)
+        found = known[pos] == ids
+        rows[found] = order[pos[found]]
+        return rows
+
+    def rows(self, ids):
+        '''Rows of candidate ids, adding unseen ids to the store'''
+        ids = np.asarray(ids, dtype=np.int64)
+        rows = self._lookup(ids)
+        new = np.unique(ids[rows < 0])
+        if len(new):
+            self._save("candidates", np.concatenate([self.candidate_ids, new]))
+            self.candidate_ids = self._load("candidates", np.int64)
+            rows = self._lookup(ids)
+        return rows
+
+    def column(self, name):
+        '''Stored column of an LF as (rows, votes, computed): memory-mapped
+        sorted rows with a non-zero vote, their votes, and a boolean array
+        over all candidate rows marking the rows already labeled'''
+        computed = np.zeros(len(self), dtype=bool)
+        if name not in self._index:
+            return np.array([], np.int64), np.array([], np.int32), computed
+        fname = self._file(name)
+        bits = np.unpackbits(self._load("{}.computed".format(fname), np.uint8))[:len(self)]
+        computed[:len(bits)] = bits
+        return (self._load("{}.rows".format(fname), np.int64),
+                self._load("{}.values".format(fname), np.int32), computed)
+
+    def _update(self, name, checksum, seen, rows, values):
+        '''Add newly labeled rows (seen) and their non-zero votes to a column,
+        replacing it if its checksum changed'''
+        if self.checksum(name) == checksum:
+            old_rows, old_values, computed = self.column(name)
+            rows = np.concatenate([old_rows, rows])
+            values = np.concatenate([old_values, values])
+        else:
+            computed = np.zeros(len(self), dtype=bool)
+        computed[seen] = True
+        order = np.argsort(rows, kind="mergesort")
+
+        # drop the column from the index while its files are rewritten
+        fname = self._file(name)
+        self._index.pop(name, None)
+        self._save_index()
+        self._save("{}.rows".format(fname), rows[order].astype(np.int64))
+        self._save("{}.values".format(fname), values[order].astype(np.int32))
+        self._save("{}.computed".format(fname), np.packbits(computed))
+        self._index[name] = {"checksum":checksum, "file":fname}
+        self._save_index()
+
+    def label_matrix(self, candidates, labeler, ids=None, n_jobs=1):
+        '''Sparse len(candidates) x len(labeler) label matrix. Only cells
+        not already stored (new candidates, new or changed LFs) are
+        computed, with apply_lfs, and then added to the store.
+
+        Parameters
+        ----------
+        candidates : list
+            Candidate mentions
+
+        labeler : DictionaryLabeler
+            Labeling functions; column j is labeler.lf_names[j]
+
+        ids : list
+            Integer candidate ids (default: each candidate's id attribute)
+
+        '''
+        candidates = candidates if isinstance(candidates, list) else list(candidates)
+        ids = [c.id for c in candidates] if ids is None else ids
+        rows, first, inverse = np.unique(self.rows(ids), return_index=True,
+                                         return_inverse=True)
+
+        # group LFs by the (unique) candidates they still need
+        checksums = {name:labeler.checksum(name) for name in labeler.lf_names}
+        pending = defaultdict(list)
+        for name in labeler.lf_names:
+            computed = self.column(name)[2] if self.checksum(name) == checksums[name] \
+                       else np.zeros(len(self), dtype=bool)
+            todo = np.where(~computed[rows])[0]
+            if len(todo):
+                pending[todo.tostring()].append(name)
+
+        for todo, names in pending.items():
+            todo = np.frombuffer(todo, dtype=np.int64)
+            matrix = apply_lfs([candidates[i] for i in first[todo]],
+                               labeler.subset(names), n_jobs).tocsc()
+            for j, name in enumerate(names):
+                column = matrix[:, j]
+                self._update(name, checksums[name], rows[todo],
+                             rows[todo][column.indices], column.data)
+
+        # gather the requested rows from the stored columns
+        position = np.full(len(self), -1, dtype=np.int64)
+        position[rows] = np.arange(len(rows))
+        entries = [(np.array([], np.int64), np.array([], np.int64), np.array([], np.int32))]
+        for j, name in enumerate(labeler.lf_names):
+            stored, values, computed = self.column(name)
+            i = position[stored]
+            entries.append((i[i >= 0], np.full((i >= 0).sum(), j, dtype=np.int64),
+                            values[i >= 0]))
+        i, j, values = [np.concatenate(x) for x in zip(*entries)]
+        matrix = csr_matrix((values, (i, j)), shape=(len(rows), len(labeler)))
+        return matrix[inverse]
@@ -0,0 +1,186 @@
+'''
+Dictionary Labeling
+
+UmlsDict.get_lfs and UmlsNoiseAwareDict.lfs generate one labeling function
+per (STY,SAB) dictionary. Applied one at a time, every function rebuilds
+(and lowercases) the mention string and probes its own dictionary, so
+labeling N candidates with K functions costs N x K string builds and
+lookups.
+
+DictionaryLabeler evaluates the same set of functions in one pass: each
+mention key is built once, looked up once in the TermStore inverted index
+(term -> every dictionary listing it), and all votes are written straight
+into a sparse N x K label matrix, one column per labeling function:
+
+    labeler = UmlsNoiseAwareDict(positive, negative).labeler()
+    L = labeler.apply(candidates)
+    L[:, labeler.columns["LF_disease_or_syndrome_MSH_pos"]]
+
+Corpora repeat the same surface mentions ("cancer", "tumor") many times,
+so by default candidates are grouped by mention key: each distinct key is
+evaluated once and its label row is scattered back to every candidate
+with that key.
+
+apply_lfs shards candidates over a process pool. Workers are forked, so
+the candidates and the term store (memory-mapped when compiled, else
+copy-on-write) are shared rather than pickled; only shard bounds and the
+partial label matrices cross process boundaries.
+
+'''
+import hashlib
+import multiprocessing
+import numpy as np
+from scipy.sparse import csr_matrix, diags, vstack
+
+
+def mention_words(m):
+    '''Mention text as joined word tokens (UmlsNoiseAwareDict.lfs)'''
+    return " ".join(m.get_attrib_tokens('words'))
+
+
+def mention_span(m):
+    '''Mention text as a sentence character slice (UmlsDict.get_lfs)'''
+    return m.sentence["text"][m.sent_char_start:m.sent_char_end+1]
+
+
+class DictionaryLabeler(object):
+    '''Fused evaluator for a set of dictionary labeling functions
+
+    Parameters
+    ----------
+    store : TermStore
+        Term store holding every referenced (STY,SAB) dictionary
+
+    lfs : list
+        (name, (sty,sab), rvalue) of each labeling function, in column order
+
+    mention : function
+        Candidate -> mention text (mention_words or mention_span)
+
+    ignore_case : bool
+        Lowercase mention text before lookup
+
+    salt : string
+        Extra settings mixed into every LF checksum
+
+    '''
+    def __init__(self, store, lfs, mention=mention_words, ignore_case=True, salt=""):
+        self.store = store
+        self.salt = salt
+        self.mention = mention
+        self.ignore_case = ignore_case
+        self.lf_names = [name for name,key,rvalue in lfs]
+        self.columns = {name:j for j,name in enumerate(self.lf_names)}
+        self.keys = [key for name,key,rvalue in lfs]
+        self.rvalues = np.array([rvalue for name,key,rvalue in lfs], dtype=np.int32)
+
+    def __len__(self):
+        return len(self.lf_names)
+
+    def subset(self, names):
+        '''Labeler for the named labeling functions only'''
+        lfs = [(name, self.keys[self.columns[name]], self.rvalues[self.columns[name]])
+               for name in names]
+        return DictionaryLabeler(self.store, lfs, self.mention, self.ignore_case, self.salt)
+
+    def checksum(self, name):
+        '''SHA-1 digest of a labeling function: its dictionary contents, 
+        vote, mention key and salt. Changes whenever its label column would.'''
+        j = self.columns[name]
+        sty, sab = self.keys[j]
+        spec = [self.store.checksum(sty, sab), sty, sab, self.rvalues[j], self.ignore_case,
+                self.store.normalize, self.mention.__name__, self.salt]
+        return hashlib.sha1("|".join(map(str, spec))).hexdigest()
+
+    def mention_key(self, m):
+        mention = self.mention(m)
+        return mention.lower() if self.ignore_case else mention
+
+    def label(self, mentions, dedupe=True):
+        '''Sparse len(mentions) x len(lfs) label matrix for mention strings
+        (already case-folded). With dedupe, each distinct string is 
+        evaluated once and its row is copied to every repeat.'''
+        if dedupe:
+            index = {}
+            rows = np.array([index.setdefault(t, len(index)) for t in mentions], dtype=np.int64)
+            unique = [None] * len(index)
+            for t, i in index.iteritems():
+                unique[i] = t
+            return self.label(unique, dedupe=False)[rows]
+        
+        ids = self.store.term_ids(mentions)
+        matrix = self.store.membership_matrix(ids, self.keys).astype(np.int32)
+        matrix = csr_matrix(matrix * diags(self.rvalues, 0, shape=(len(self), len(self))))
+        matrix.eliminate_zeros()
+        return matrix
+
+    def apply(self, candidates, dedupe=True):
+        '''Sparse len(candidates) x len(lfs) label matrix. Column j holds
+        the votes of lf_names[j]; abstains (0) are not stored.'''
+        return self.label([self.mention_key(m) for m in candidates], dedupe)
+
+
+_WORKER_LFS = None
+
+def _apply(candidates, lfs):
+    '''Label matrix of a DictionaryLabeler or a list of LF functions'''
+    if isinstance(lfs, DictionaryLabeler):
+        return lfs.apply(candidates)
+    rows, cols, data = [], [], []
+    for i, c in enumerate(candidates):
+        for j, lf in enumerate(lfs):
+            value = lf(c)
+            if value:
+                rows.append(i)
+                cols.append(j)
+                data.append(value)
+    return csr_matrix((np.array(data, dtype=np.int32), (rows, cols)),
+                      shape=(len(candidates), len(lfs)))
+
+
+def _init_worker(candidates, lfs):
+    '''Hand a worker the full candidate list and the labeler (or LF list);
+    _apply_shard then only receives (start, end) bounds into it'''
+    global _WORKER_LFS
+    _WORKER_LFS = (candidates, lfs)
+
+
+def _apply_shard(bounds):
+    candidates, lfs = _WORKER_LFS
+    start, end = bounds
+    return _apply(candidates[start:end], lfs)
+
+
+def apply_lfs(candidates, lfs, n_jobs=None, chunksize=50000):
+    '''Apply labeling functions to candidates, returning a sparse 
+    len(candidates) x len(lfs) label matrix
+
+    Parameters
+    ----------
+    candidates : list
+        Candidate mentions
+
+    lfs : DictionaryLabeler or list of functions
+        Column j holds the votes of lfs[j] (or lfs.lf_names[j])
+
+    n_jobs : int
+        Worker processes (default one per core), each labeling shards 
+        of chunksize candidates
+
+    '''
+    candidates = candidates if isinstance(candidates, list) else list(candidates)
+    n_jobs = multiprocessing.cpu_count() if n_jobs is None else n_jobs
+    bounds = [(i, min(i + chunksize, len(candidates)))
+              for i in range(0, len(candidates), chunksize)]
+    if min(n_jobs, len(bounds)) <= 1:
+        return _apply(candidates, lfs)
+    
+    # build the inverted index before forking, so workers share one copy
+    if isinstance(lfs, DictionaryLabeler):
+        lfs.store._inverted()
+    pool = multiprocessing.Pool(min(n_jobs, len(bounds)), _init_worker, (candidates, lfs))
+    try:
+        results = pool.map(_apply_shard, bounds, chunksize=1)
+    finally:
+        pool.terminate()
+    return vstack(results, format="csr")
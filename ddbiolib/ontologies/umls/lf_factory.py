@@ -16,11 +16,14 @@ import glob
 import codecs
 import itertools
 import subprocess
+import numpy as np
 from functools import partial
 from collections import defaultdict
 from ...utils import database
 from .config import DEFAULT_UMLS_CONFIG
 from .metathesaurus import MetaNorm
+from .term_store import DictionaryCache, TermSet
+from .labeling import DictionaryLabeler, mention_words, apply_lfs
 
 def dict_function_factory(dictionary,rvalue,name,ignore_case=True):
     '''Dynamically create a labeling function object'''
@@ -45,13 +48,11 @@ def build_umls_dictionaries(config,min_occur=1):
     abbrv_tty = dict.fromkeys(['AA','AB','ACR'])
     not_term_tty = dict.fromkeys(['AA','AB','ACR','AUN']) 
     
-    conn = database.MySqlConn(config.host, config.username, 
-                              config.dbname, config.password)
-    conn.connect()
+    conn = database.connect(config)
     sql_tmpl = "{}/sql_tmpl/sty_sab_dictionaries.sql".format(module_path)
     sql = "".join(open(sql_tmpl,"rU").readlines())
     
-    results = conn.query(sql)
+    results = conn.iter_query(sql)
     abbrv = defaultdict(partial(defaultdict, defaultdict))
     terms = defaultdict(partial(defaultdict, defaultdict))
     
@@ -88,12 +89,13 @@ def build_umls_dictionaries(config,min_occur=1):
             subprocess.call(["bzip2", outfname]) # compress file                
     
 
-class UmlsNoiseAwareDict(object):
+class UmlsNoiseAwareDict(DictionaryCache):
     '''Use UMLS semantic types and source vocabulary information
     to create labeling functions for providing supervision for 
     tagging tasks'''
     def __init__(self, positive=[], negative=[], name="", rm_sab=[],
-                 rootdir=None, ignore_case=True, normalize=True):
+                 rootdir=None, ignore_case=True, normalize=True, n_jobs=1,
+                 compiled=False):
         
         module_path = os.path.dirname(__file__)
         self.rootdir = rootdir if rootdir else "{}/data/cache/{}/".format(module_path,name)
@@ -102,7 +104,10 @@ class UmlsNoiseAwareDict(object):
         self.name = name
         self.encoding = "utf-8"
         self.ignore_case = ignore_case
-        self._dictionary = self._load_dictionaries(normalize)
+        self.normalize = normalize
+        self.n_jobs = n_jobs
+        self.compiled = compiled
+        self._dictionary = self._load_dictionaries(normalize, interned=True)
         self.rm_sab = rm_sab
         
     
@@ -110,56 +115,25 @@ class UmlsNoiseAwareDict(object):
         return s.lower().replace(" ","_")
     
     
-    def _load_dictionaries(self,normalize):
-        '''Load dictionaries base on provided positive/negative 
-        entity examples'''
-        d = defaultdict(defaultdict)
-        filelist = glob.glob("{}*.txt.bz2".format(self.rootdir))
-        
-        mn = MetaNorm()
-        
-        for fpath in filelist:
-            fname = fpath.split("/")[-1].rstrip(".txt.bz2")
-            i = fname.index(".")
-            sty,sab = fname[0:i], fname[i+1:].rstrip(".abbrv")
-            dict_type = "terms" if "abbrv" not in fname else "abbrv"
-            
-            # skip semantic types we don't flag as postive of negative
-            if sty not in self.positive and sty not in self.negative:
-                continue
-            
-            terms = []
-            with bz2.BZ2File(fpath,"rb") as f:
-                for line in f:
-                    if not line.strip():
-                        continue
-                    try:
-                        line = line.strip().decode('utf-8')
-                        t = line.strip().lower() if self.ignore_case else line.strip()
-                        if normalize:
-                            t = mn.normalize(t)
-                        terms += [t]
-                    except:
-                        print>>sys.stderr,"Warning: unicode conversion error"
-            
-            if sty in d and sab in d[sty]:    
-                d[sty][sab].update(dict.fromkeys(terms))
-            else:
-                d[sty][sab] = dict.fromkeys(terms)
-            
-            
-            
-        return d    
+    def _selected(self,sty,sab):
+        '''Skip semantic types we don't flag as postive of negative'''
+        return sty in self.positive or sty in self.negative
     
     
     def get_semantic_types(self,term):
-        '''Return all matching semantic types for this term '''
+        '''Return all matching semantic types for this term (and the 
+        number of source vocabularies listing it) from the inverted index'''
         stys = {}
-        for sty in self._dictionary:
-            for sab in self._dictionary[sty]:
-                if term in self._dictionary[sty][sab]:
-                    stys[sty] = stys.get(sty,0) + 1    
+        for sty,sab in self.store.dictionaries_of(term):
+            if sty in self._dictionary and sab in self._dictionary[sty]:
+                stys[sty] = stys.get(sty,0) + 1    
         return stys
+    
+    def semantic_type_matrix(self,terms):
+        '''Batch get_semantic_types: sparse len(terms) x semantic type 
+        count matrix and its column semantic types'''
+        keys = [(sty,sab) for sty in self._dictionary for sab in self._dictionary[sty]]
+        return self.store.type_matrix(terms, keys)
                     
     def get_dictionary(self,semantic_types=[],source_vocab=[], min_size=1):
         return self.dictionary(semantic_types,source_vocab, min_size)
@@ -176,7 +150,7 @@ class UmlsNoiseAwareDict(object):
         source_vocab = dict.fromkeys(sabs) if not source_vocab else source_vocab    
         
         # filter ontologies by size and source
-        d = []
+        d, ids = {}, []
         for sty in self._dictionary:
             
             if sty not in self.positive and positive_only:
@@ -194,13 +168,19 @@ class UmlsNoiseAwareDict(object):
                 if "ears" in self._dictionary[sty][sab]:
                     print sty,sab
                 
-                d += self._dictionary[sty][sab].keys()
-
-        return dict.fromkeys(d)
+                if isinstance(self._dictionary[sty][sab], TermSet):
+                    ids.append(self._dictionary[sty][sab].ids)
+                else:
+                    d.update(self._dictionary[sty][sab])
         
+        # union term ids, then decode each distinct term once
+        if ids:
+            d.update(dict.fromkeys(self.store.terms(np.unique(np.concatenate(ids)))))
+        return d
         
-    def lfs(self,min_size=0):
-        '''Create labeling functions for each semantic type/source vocabulary'''
+        
+    def _lf_specs(self,min_size=0):
+        '''(name, (sty,sab), rvalue) of each labeling function'''
         for sty in self._dictionary:
             for sab in self._dictionary[sty]:
                 if sab in self.rm_sab:
@@ -213,8 +193,24 @@ class UmlsNoiseAwareDict(object):
                 prefix = "{}_".format(self.name) if self.name else ""
                 func_name = "LF_{}{}_{}_{}".format(prefix,sty,sab,label)
                 rvalue = 1 if label=="pos" else -1
-                yield dict_function_factory(self._dictionary[sty][sab],rvalue,
-                                            func_name,self.ignore_case)
+                yield func_name,(sty,sab),rvalue
+    
+    def lfs(self,min_size=0):
+        '''Create labeling functions for each semantic type/source vocabulary'''
+        for func_name,(sty,sab),rvalue in self._lf_specs(min_size):
+            yield dict_function_factory(self._lf_dictionary(sty,sab),rvalue,
+                                        func_name,self.ignore_case)
+    
+    def labeler(self,min_size=0):
+        '''Fused evaluator of the same labeling functions as lfs(), 
+        producing a sparse label matrix in one pass'''
+        return DictionaryLabeler(self.store, list(self._lf_specs(min_size)),
+                                 mention_words, self.ignore_case)
+    
+    def apply_lfs(self,candidates,min_size=0,n_jobs=None):
+        '''Label matrix of lfs() over candidates, sharded over n_jobs 
+        worker processes (see labeling.apply_lfs)'''
+        return apply_lfs(candidates, self.labeler(min_size), n_jobs)
                 
 
 if __name__ == "__main__":
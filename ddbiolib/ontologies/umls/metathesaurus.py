@@ -1,10 +1,40 @@
 import re
 import os
+import inspect
+import itertools
+import functools
+import multiprocessing
+import numpy as np
 import networkx as nx
+from collections import OrderedDict
 from ...utils import database
+from ...utils.cache import LRUCache, DiskCache
 from .config import DEFAULT_UMLS_CONFIG
+from .graph import ConceptGraph
+from .type_index import SemanticTypeIndex
 from .semantic_network import SemanticNetwork
 
+_MISSING = object()
+
+def _disk_cached(method):
+    '''Persist method results in the object's disk cache (when enabled), 
+    keyed by method name, normalized arguments and the object's default 
+    source vocabularies'''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.disk_cache is None:
+            return method(self, *args, **kwargs)
+        callargs = inspect.getcallargs(method, self, *args, **kwargs)
+        del callargs["self"]
+        key = [method.__name__, callargs, list(self.source_vocab)]
+        value = self.disk_cache.get(key, _MISSING)
+        if value is _MISSING:
+            value = method(self, *args, **kwargs)
+            self.disk_cache[key] = value
+        return value
+    return wrapper
+
+
 class Metathesaurus(object):
     """
     This class hides a bunch of messy SQL queries that interface with a UMLS
@@ -14,32 +44,56 @@ class Metathesaurus(object):
     
     The NLM also provides a REST API for similar functionality, but since we
     look at global term sets, network structures, etc. its better to query 
-    from a local UMLS database instance. 
+    from a local UMLS database instance. Set config.backend="sqlite" to 
+    query an offline snapshot built from the RRF release files (see 
+    snapshot.build_snapshot) instead of a MySQL server.
     
     All source abbreviations:
     https://www.nlm.nih.gov/research/umls/knowledge_sources/metathesaurus/release/abbreviations.html
     
+    Queries go through a connection pool shared with the SemanticNetwork
+    (and any other object built from the same config), so methods can be
+    called concurrently from a thread pool, e.g.
+    
+        ThreadPool(8).map(meta.concept, cuis)
+    
+    pool_size resizes the shared pool (default 8 connections).
+    
+    Set cache_dir to persist the results of expensive queries (concept 
+    graphs, dictionaries, relations) across processes. Entries are keyed 
+    by the UMLS release, so they are invalidated when the release changes.
+    
     TODO: optimize queries. make less hacky overall
     
     """
-    def __init__(self, config, source_vocab=[]):
+    def __init__(self, config, source_vocab=[], cache_size=100000, 
+                 pool_size=None, cache_dir=None):
         
-        self.conn = database.MySqlConn(host=config.host,
-                                       user=config.username, 
-                                       database=config.dbname, 
-                                       password=config.password)
-        
-        self.conn.connect()
+        self.config = config
+        self.conn = database.connection_pool(config, pool_size)
         self.norm = MetaNorm()
         self.semantic_network = SemanticNetwork(config)
         
         self.source_vocab = source_vocab # source vocabularies (SAB)
-        self._concepts = {}
+        self._concepts = LRUCache(cache_size)
         self._networks = {}
         
         self.term_types = None
         self.source_vocab_defs = None
         self._sql_tmpl = {}
+        
+        self.disk_cache = None
+        if cache_dir:
+            namespace = "{}.{}".format(os.path.basename(str(config.dbname)),
+                                       self.release()[0:12])
+            self.disk_cache = DiskCache(cache_dir, namespace)
+    
+    
+    def release(self):
+        '''Fingerprint of the UMLS release served by this database: the
+        database name plus every source vocabulary version in MRSAB'''
+        versions = sorted(self.conn.query("SELECT RSAB,SVER FROM MRSAB"))
+        return DiskCache.checksum([self.config.dbname, versions])
 
 
     def _load_sql_tmpl(self,fname):
@@ -54,7 +108,7 @@ class Metathesaurus(object):
             
     
     def concept_graph(self, level="CUI", relation=["CHD"],  
-                      source_vocab=[], simulate_root=True):
+                      source_vocab=[], simulate_root=True, compact=False):
         """Build a concept graph for the target relation. 
         
         The REL field contains the relation type and RELA encodes the relation 
@@ -78,13 +132,23 @@ class Metathesaurus(object):
         
         simulate_root : Some concept graphs lack a shared root node which
             breaks several measures. This adds a simulated root.
+        
+        compact : boolean, optional (default=False)
+            Return a ConceptGraph (integer-interned CSR arrays) instead of 
+            a networkx.DiGraph. Use ConceptGraph.to_networkx() to convert.
             
         """
         # load cached graph
-        key = "%s_%s_%s" % (level,".".join(source_vocab),".".join(relation))
+        key = "%s_%s_%s_%s" % (level,".".join(source_vocab),".".join(relation),compact)
         if key in self._networks:
             return self._networks[key]
         
+        self._networks[key] = self._concept_graph(level, relation, source_vocab, compact)
+        return self._networks[key]
+        
+    
+    @_disk_cached
+    def _concept_graph(self, level, relation, source_vocab, compact):
         # source vocabulary (override class default)
         sab = self._source_vocab_sql(source_vocab) if source_vocab else \
               self._source_vocab_sql(self.source_vocab)
@@ -96,14 +160,15 @@ class Metathesaurus(object):
                  WHERE %s %s;"""
                  
         sql = sql % (level,level,sab,rel_types)
-        results = self.conn.query(sql)
+        
+        if compact:
+            return ConceptGraph.from_edges(self.conn.iter_query(sql))
         
         G = nx.DiGraph()
-        for row in results:
+        for row in self.conn.iter_query(sql):
             parent,child,rel,rela = row
             G.add_edge(parent,child,rel=rel,attribute=rela)
       
-        self._networks[key] = G
         return G
         
         
@@ -118,6 +183,7 @@ class Metathesaurus(object):
         return sab
     
     
+    @_disk_cached
     def get_source_vocabulary_defs(self):
         """Return dictionary of UMLS source vocabularies descriptions."""
         if self.source_vocab_defs:
@@ -135,6 +201,7 @@ class Metathesaurus(object):
         return summary
     
                 
+    @_disk_cached
     def get_relations_list(self, counts=False):
         """"Get distinct UMLS relation types and their occurrence count."""
         sql = "SELECT DISTINCT(RELA),count(RELA) FROM MRREL %s GROUP BY RELA"
@@ -150,6 +217,7 @@ class Metathesaurus(object):
         return results if counts else zip(*results)[0]
     
     
+    @_disk_cached
     def get_tty_list(self,ignore=['OAS','OAP','OAF','FN','OF',
                                   'MTH_OF','MTH_IS','LPN','AUN']):
         if self.term_types:
@@ -162,6 +230,7 @@ class Metathesaurus(object):
         return self.term_types
     
     
+    @_disk_cached
     def get_semtypes_list(self, counts=False):
         """ Get distinct UMLS semantic types and their occurrence counts."""
         sql = "SELECT DISTINCT(STY),count(STY) FROM MRSTY GROUP BY STY"
@@ -169,25 +238,91 @@ class Metathesaurus(object):
         return results if counts else zip(*results)[0]
     
     
+    def _source_vocab_params(self, source_vocab):
+        """Build bound parameter source vocabulary sql, falling back to the 
+        object default source vocabulary. Returns (sql, params)"""
+        source_vocab = source_vocab if source_vocab else self.source_vocab
+        if not source_vocab:
+            return "", []
+        sab = "SAB IN ({})".format(self.conn.placeholders(len(source_vocab)))
+        return sab, list(source_vocab)
+    
+    
     def match_concepts(self, s, source_vocab=[], match_substring=False):
         """Find exact matches to provided string and return CUI set"""
-        if not match_substring:
-            sql = "SELECT DISTINCT(CUI) FROM MRCONSO WHERE %s STR='%s'"
-        else:
-            sql = "SELECT DISTINCT(CUI) FROM MRCONSO WHERE %s STR LIKE '%s%%'"
+        return self.match_concepts_many([s], source_vocab, match_substring)[s]
+    
+    
+    def match_concepts_many(self, strings, source_vocab=[], 
+                            match_substring=False, batch_size=500):
+        """Find matches for a collection of strings using batched, 
+        parameterized queries (one round trip per batch_size strings).
         
-        # override object default source vocabulary?
-        if source_vocab:
-            sab = self._source_vocab_sql(source_vocab)
-        else:
-            sab = self._source_vocab_sql(self.source_vocab)
+        Parameters
+        ----------
+        strings : iterable
+            Strings to match against MRCONSO.STR
+        
+        source_vocab : array, optional
+            Override object source vocabularies (SAB)
+            
+        match_substring : boolean, optional
+            Match strings as prefixes (STR LIKE 's%') instead of exact matches
+        
+        batch_size : int, optional
+            Number of strings bound per query
+            
+        Returns
+        -------
+        dict mapping each input string to a list of CUIs
+        """
+        strings = list(dict.fromkeys(strings))
+        matches = {s:[] for s in strings}
+        sab, sab_params = self._source_vocab_params(source_vocab)
         sab = "" if not sab else sab + " AND"
-        sql = sql % (sab,s)
         
-        results = self.conn.query(sql)
-        return [cui[0] for cui in results]
-
+        for i in range(0, len(strings), batch_size):
+            batch = strings[i:i + batch_size]
+            if not match_substring:
+                sql = "SELECT DISTINCT STR,CUI FROM MRCONSO WHERE {} STR IN ({})"
+                sql = sql.format(sab, self.conn.placeholders(len(batch)))
+                params = sab_params + batch
+            else:
+                like = " OR ".join(["STR LIKE {} ESCAPE '!'".format(self.conn.placeholder)] * len(batch))
+                sql = "SELECT DISTINCT STR,CUI FROM MRCONSO WHERE {} ({})".format(sab, like)
+                params = sab_params + [re.sub("([!%_])", "!\\1", s) + "%" for s in batch]
+            
+            results = self.conn.query(sql, params)
+            self._collect_matches(batch, results, matches, match_substring)
         
+        return matches
+    
+    
+    def _collect_matches(self, batch, results, matches, match_substring):
+        """Assign (STR,CUI) rows back to the input strings that matched them. 
+        Exact matches are case sensitive unless the database collation 
+        matched a different case, LIKE prefix matches are case insensitive."""
+        if not match_substring:
+            exact = {s:[s] for s in batch}
+            nocase = {}
+            for s in batch:
+                nocase.setdefault(s.lower(), []).append(s)
+            keys = lambda string: exact.get(string, nocase.get(string.lower(), []))
+        else:
+            prefixes = {}
+            for s in batch:
+                prefixes.setdefault(s.lower(), []).append(s)
+            lengths = sorted(set(map(len, prefixes)))
+            keys = lambda string: [s for n in lengths for s in 
+                                   prefixes.get(string[:n].lower(), [])]
+        
+        for string, cui in results:
+            for s in keys(string):
+                if cui not in matches[s]:
+                    matches[s].append(cui)
+    
+        
+    @_disk_cached
     def dictionary(self, semantic_type, source_vocab=[], cui_dict=False, 
                    include_children=True, exclude_subtrees=[],
                    term_types=[]):
@@ -218,17 +353,16 @@ class Metathesaurus(object):
         """
         tmpl = self._load_sql_tmpl("dictionary.sql")
         term_types = term_types if term_types else self.get_tty_list()
-        network = self.semantic_network.graph("isa")
         
         # exclude subtrees
         if include_children:
-            children = [node for node in nx.bfs_tree(network, semantic_type)]
+            children = self.semantic_network.subtypes(semantic_type)
         else:
-            children = [semantic_type]
+            children = set([semantic_type])
             
         if exclude_subtrees:
-            rm = [nx.bfs_tree(network, subtree_root).nodes() for subtree_root in exclude_subtrees]
-            children = [node for node in children if node not in reduce(lambda x,y:x+y,rm)]
+            children = children - self._semantic_subtypes(exclude_subtrees)
+        children = sorted(children)
         children = "STY IN ({})".format(",".join(map(lambda x:"'%s'" % x, children)))
         
         # override object default source vocabulary?
@@ -238,13 +372,13 @@ class Metathesaurus(object):
             sab = self._source_vocab_sql(self.source_vocab)
         
         tty = "TTY IN (%s)" % ",".join(map(lambda x:"'%s'" % x, term_types))
-        sql = tmpl.format(sab,tty,children)
+        sql = tmpl.format(" AND ".join([x for x in [sab,tty] if x]),children)
         
-        results = self.conn.query(sql)
+        results = self.conn.iter_query(sql)
         
         # collapse to unique strings
         if not cui_dict:
-            vocab = {self.norm.normalize(row[2]):1 for row in results}
+            vocab = dict.fromkeys((self.norm.normalize(row[2]) for row in results), 1)
             if "" in vocab:
                 del vocab[""]
         else:
@@ -256,67 +390,232 @@ class Metathesaurus(object):
     def concept(self, cui, source_vocab=[]):
         """Build UMLS concept, including abbreviations, synonyms, and preferred 
         forms."""
-        if cui in self._concepts:
-            return self._concepts[cui]
-        else: 
-            return Concept(cui, self.conn, source_vocab)
+        key = (cui,tuple(source_vocab))
+        concept = self._concepts.get(key)
+        if concept is None:
+            concept = Concept(cui, self.conn, source_vocab)
+            self._concepts[key] = concept
+        return concept
+    
+    
+    def concepts(self, cuis, source_vocab=[], batch_size=400):
+        """Build a batch of UMLS concepts, loading MRCONSO and MRDEF rows 
+        for batch_size CUIs per query. Concepts are stored in the concept 
+        cache so later concept() calls don't query the database.
+        
+        Returns
+        -------
+        dict mapping each CUI to its Concept
+        """
+        concepts, missing = {}, []
+        for cui in OrderedDict.fromkeys(cuis):
+            concept = self._concepts.get((cui,tuple(source_vocab)))
+            if concept is None:
+                missing.append(cui)
+            else:
+                concepts[cui] = concept
+        
+        for i in range(0, len(missing), batch_size):
+            batch = missing[i:i + batch_size]
+            fields = Concept.fetch(self.conn, batch)
+            for cui in batch:
+                atoms,definitions = fields[cui]
+                concept = Concept(cui, self.conn, source_vocab, atoms, definitions)
+                self._concepts[(cui,tuple(source_vocab))] = concept
+                concepts[cui] = concept
+                
+        return concepts
+    
+    
+    def cache_info(self):
+        """Concept cache hits, misses and size"""
+        return self._concepts.info()
     
         
     def relations_on_cui(self, cui, source_vocab=[]):
         """Return set of relations associated with this concept."""
-        sql = """SELECT RUI,SL,RELA,CUI1,CUI2 FROM MRREL R 
-                 WHERE %s (R.CUI1="%s" OR R.CUI2="%s")
-                 AND RELA!='NULL';"""
+        # a UNION of two indexed lookups instead of an OR-ed scan
+        sql = """SELECT RUI,SL,RELA,CUI1,CUI2 FROM MRREL 
+                 WHERE {0} CUI1={1} AND RELA!='NULL' UNION
+                 SELECT RUI,SL,RELA,CUI1,CUI2 FROM MRREL 
+                 WHERE {0} CUI2={1} AND RELA!='NULL';"""
         
-        # override object default source vocabulary?
-        if source_vocab:
-            sab = self._source_vocab_sql(source_vocab)
-        else:
-            sab = self._source_vocab_sql(self.source_vocab)
+        sab, params = self._source_vocab_params(source_vocab)
         sab = "" if not sab else sab + " AND"
         
-        sql = sql %  (sab,cui,cui)
-        results = self.conn.query(sql)
+        sql = sql.format(sab, self.conn.placeholder)
+        results = self.conn.query(sql, params + [cui] + params + [cui])
         return results
             
             
     def relations_between_cui(self, cui1, cui2):
+        """Return set of (REL,RELA) relations between provided concepts"""
+        return self.relations_between([(cui1,cui2)])[(cui1,cui2)]
+    
+    
+    def relations_between(self, pairs, source_vocab=[], batch_size=400,
+                          use_index=None, index_min_pairs=10000):
+        """Return every MRREL relation between each (CUI1,CUI2) pair.
+        
+        Parameters
+        ----------
+        pairs : array
+            (CUI1,CUI2) pairs
+        
+        source_vocab : array, optional
+            Override object source vocabularies (SAB)
+            
+        batch_size : int, optional
+            Number of pairs per query
+        
+        use_index : boolean, optional
+            Answer from an in-memory pair index over all of MRREL (see 
+            relation_index) instead of batched queries. Building the index
+            reads all of MRREL, so by default it is only used once built, 
+            or for offline (sqlite) snapshots when there are at least 
+            index_min_pairs pairs.
+        
+        index_min_pairs : int, optional
+            Batch size from which the index pays for itself
+        
+        Returns
+        -------
+        dict mapping each pair to a list of distinct (REL,RELA) tuples
         """
-        Return set of relations between provided concepts
-        TODO
-        """
-        pass
+        pairs = list(OrderedDict.fromkeys(map(tuple, pairs)))
+        if use_index is None:
+            key = "relations_%s" % ".".join(source_vocab)
+            use_index = key in self._networks or (len(pairs) >= index_min_pairs and
+                        getattr(self.config, "backend", "mysql") == "sqlite")
+        
+        if use_index:
+            index = self.relation_index(source_vocab)
+            return dict(zip(pairs, index.edges_between(pairs)))
+        
+        relations = {pair:[] for pair in pairs}
+        sab, sab_params = self._source_vocab_params(source_vocab)
+        sab = "" if not sab else sab + " AND"
+        
+        # group by CUI1 so each batch is a small CUI1 x CUI2 IN-list product
+        pairs = sorted(pairs)
+        for i in range(0, len(pairs), batch_size):
+            batch = pairs[i:i + batch_size]
+            cui1 = list(OrderedDict.fromkeys([p[0] for p in batch]))
+            cui2 = list(OrderedDict.fromkeys([p[1] for p in batch]))
+            sql = """SELECT DISTINCT CUI1,CUI2,REL,RELA FROM MRREL 
+                     WHERE {} CUI1 IN ({}) AND CUI2 IN ({})"""
+            sql = sql.format(sab, self.conn.placeholders(len(cui1)), 
+                             self.conn.placeholders(len(cui2)))
+            
+            for c1,c2,rel,rela in self.conn.query(sql, sab_params + cui1 + cui2):
+                if (c1,c2) in relations:
+                    relations[(c1,c2)].append((rel,rela))
+        
+        return relations
+    
+    
+    def relation_index(self, source_vocab=[]):
+        """In-memory index of every MRREL relation, stored as a ConceptGraph
+        that keeps all distinct (REL,RELA) per CUI pair. Built once by 
+        streaming MRREL (and persisted in the disk cache when enabled)."""
+        key = "relations_%s" % ".".join(source_vocab)
+        if key not in self._networks:
+            self._networks[key] = self._relation_index(source_vocab)
+        return self._networks[key]
+    
+    
+    @_disk_cached
+    def _relation_index(self, source_vocab):
+        sab, params = self._source_vocab_params(source_vocab)
+        sql = "SELECT CUI1,CUI2,REL,RELA FROM MRREL {}".format(
+              "WHERE " + sab if sab else "")
+        return ConceptGraph.from_edges(self.conn.iter_query(sql, params), collapse=False)
 
 
-    def relations(self, sty1, sty2, rela, source_vocab=[]):
-        """Return set of relations between provided semantic types"""
-        # collect descendant/child types for each semantic type
-        network = self.semantic_network.graph("isa")
-        sty1 = [node for node in nx.bfs_tree(network, sty1)]
-        sty2 = [node for node in nx.bfs_tree(network, sty2)]
-        sty1 = " OR ".join(map(lambda x:"STY='%s'" % x, sty1))
-        sty2 = " OR ".join(map(lambda x:"STY='%s'" % x, sty2))
+    def semantic_type_index(self):
+        """In-memory CUI -> semantic type index over all of MRSTY, with 
+        per-CUI type bitmasks and semantic group masks (see 
+        SemanticNetwork.groups). Built once (and persisted in the disk 
+        cache when enabled)."""
+        if "semantic_types" not in self._networks:
+            index = self._semantic_type_index()
+            network = self.semantic_network
+            index.groups = {abbrv:network.groups[name] for abbrv,name in network.abbrv.items()}
+            self._networks["semantic_types"] = index
+        return self._networks["semantic_types"]
+    
+    
+    @_disk_cached
+    def _semantic_type_index(self):
+        return SemanticTypeIndex.from_rows(self.conn.iter_query("SELECT CUI,STY FROM MRSTY"))
+    
+    
+    def _semantic_subtypes(self, semantic_types):
+        """Semantic types plus all their descendant types"""
+        if isinstance(semantic_types, basestring):
+            semantic_types = [semantic_types]
+        subtypes = set()
+        for sty in semantic_types:
+            subtypes.update(self.semantic_network.subtypes(sty))
+        return subtypes
+    
+    
+    def iter_relations(self, sty1, sty2, rela, source_vocab=[]):
+        """Stream distinct (CUI2,CUI1) pairs of MRREL relations where CUI2 
+        has semantic type sty1 and CUI1 has semantic type sty2 (or any of 
+        their subtypes). 
         
-        # override object default source vocabulary?
-        if source_vocab:
-            sab = self._source_vocab_sql(source_vocab)
-        else:
-            sab = self._source_vocab_sql(self.source_vocab)
-        sab = "" if not sab else sab + " AND"
+        Parameters
+        ----------
+        sty1, sty2 : string or array
+            Semantic type(s). Each type includes its whole isa subtree.
         
-        sql = """
-        SELECT DISTINCT CUI2,CUI1 FROM 
-        (SELECT * FROM MRREL WHERE RELA='%s') AS R,
-        (SELECT L.CUI FROM MRCONSO AS L, MRSTY AS LS WHERE (%s) AND L.CUI=LS.CUI) AS LARG,
-        (SELECT R.CUI FROM MRCONSO AS R, MRSTY AS RS WHERE (%s) AND R.CUI=RS.CUI) AS RARG
-        WHERE %s ((LARG.CUI=CUI2) AND (RARG.CUI=CUI1));"""
-       
-        sql = sql % (rela,sty1,sty2,sab)
-        results = self.conn.query(sql)
+        rela : string or array
+            Relation attribute(s) (RELA), e.g. "may_treat"
         
-        return results
+        source_vocab : array, optional
+            Override object source vocabularies (SAB)
+        """
+        index = self.relation_index(source_vocab)
+        types = self.semantic_type_index()
+        
+        edges = index.edges_by_rela(rela)
+        cui1 = index.edge_sources()[edges]
+        cui2 = index.indices[edges]
+        
+        # check types once per distinct concept, not per edge
+        uniq, inverse = np.unique(np.concatenate([cui2, cui1]), return_inverse=True)
+        names = index.nodes[uniq]
+        mask1 = types.has_type(names, self._semantic_subtypes(sty1))
+        mask2 = types.has_type(names, self._semantic_subtypes(sty2))
+        keep = mask1[inverse[:len(edges)]] & mask2[inverse[len(edges):]]
+        
+        n = len(index.nodes)
+        pairs = np.unique(cui2[keep].astype(np.int64) * n + cui1[keep])
+        for key in pairs:
+            yield (index.nodes[key // n], index.nodes[key % n])
+    
+    
+    @_disk_cached
+    def relations(self, sty1, sty2, rela, source_vocab=[]):
+        """Return list of distinct (CUI2,CUI1) relations between provided 
+        semantic types (see iter_relations)"""
+        return list(self.iter_relations(sty1, sty2, rela, source_vocab))
     
 
+_WORKER_NORM = None
+
+def _init_normalizer(norm):
+    """Process pool initializer. Pool workers are forked with their 
+    initargs, so custom functions (e.g. lambdas) need not pickle, and the
+    global is only ever set in the worker process."""
+    global _WORKER_NORM
+    _WORKER_NORM = norm
+
+def _normalize_chunk(chunk):
+    return [_WORKER_NORM.apply(s) for s in chunk]
+
+
 class TextNorm(object):
     def __init__(self, function=lambda x:x):
         self.function = function
@@ -328,45 +627,92 @@ class TextNorm(object):
     
     def apply(self,s):
         return self.normalize(s)   
+    
+    def normalize_many(self, strings, n_jobs=1, chunksize=20000):
+        """Apply the normalizer to an iterable of strings, returning a list 
+        in input order (so subclasses overriding apply() keep their logic). 
+        With n_jobs > 1 chunks are normalized in a process pool."""
+        if n_jobs <= 1:
+            return [self.apply(s) for s in strings]
+        
+        strings = list(strings)
+        chunks = [strings[i:i + chunksize] for i in range(0, len(strings), chunksize)]
+        pool = multiprocessing.Pool(n_jobs, _init_normalizer, (self,))
+        try:
+            results = pool.map(_normalize_chunk, chunks)
+        finally:
+            pool.terminate()
+        return list(itertools.chain.from_iterable(results))
+    
    
 class MetaNorm(TextNorm):
     """
     Normalize UMLS Metathesaurus concept strings. 
+    
+    Patterns are compiled once, strings without any clutter skip the 
+    rewrite rules entirely, and results are memoized in a bounded cache 
+    (emptied when it reaches cache_size; 0 disables it), so function 
+    should be pure.
     """
-    def __init__(self, function=lambda x:x):
+    # TTY in [OF,FN] suffixes
+    suffixes = ['qualifier value', 'life style', 'cell structure', 
+                 'context\\-dependent category', 'inactive concept', 
+                 'navigational concept', 'lck', 'record artifact', 
+                 'core metadata concept', 'substance', 'event', 
+                 'organism', 'person', 'attribute', 'procedure', 
+                 'tumor staging', 'a', 'cell', 'chloroaniline', 
+                 'product', 'specimen', 'observable entity', 
+                 'racial group', 'si', 'namespace concept', 
+                 'environment', 'social concept', 'ras', 
+                 'special concept', 'staging scale', 'disorder',
+                 'geographic location', 'occupation', 'ethnic group',
+                 'body structure', 'situation', 'physical force', 
+                 'trans', 'finding', 'epoxymethano', 'linkage concept', 
+                 'assessment scale', 'metadata', 'link assertion', 
+                 'dithiocarbamates', 'foundation metadata concept',  
+                 'morphologic abnormality', 'physical object']
+    of_fn_rgx = "\(({})\)$".format("|".join(suffixes))
+    
+    bracket_rgx = re.compile("[(\[<].+[>)\]]$")
+    nos_rgx = re.compile("(\[brand name\]|[,]* NOS)+")
+    char_rgx = re.compile("(\[.{1}\])+")
+    retired_rgx = re.compile("\-RETIRED\-$")
+    suffix_rgx = re.compile(of_fn_rgx)
+    
+    # strings that match none of these are left unchanged by the rules
+    clutter_rgx = re.compile("\-\-|\[| NOS|\-RETIRED\-|[>)\]]$|^[\s_:]|[\s_:]$", re.UNICODE)
+    
+    def __init__(self, function=lambda x:x, cache_size=100000):
         super(MetaNorm, self).__init__(function)
-        
-        # TTY in [OF,FN] suffixes
-        suffixes = ['qualifier value', 'life style', 'cell structure', 
-                     'context\\-dependent category', 'inactive concept', 
-                     'navigational concept', 'lck', 'record artifact', 
-                     'core metadata concept', 'substance', 'event', 
-                     'organism', 'person', 'attribute', 'procedure', 
-                     'tumor staging', 'a', 'cell', 'chloroaniline', 
-                     'product', 'specimen', 'observable entity', 
-                     'racial group', 'si', 'namespace concept', 
-                     'environment', 'social concept', 'ras', 
-                     'special concept', 'staging scale', 'disorder',
-                     'geographic location', 'occupation', 'ethnic group',
-                     'body structure', 'situation', 'physical force', 
-                     'trans', 'finding', 'epoxymethano', 'linkage concept', 
-                     'assessment scale', 'metadata', 'link assertion', 
-                     'dithiocarbamates', 'foundation metadata concept',  
-                     'morphologic abnormality', 'physical object']
-        self.of_fn_rgx = "\(({})\)$".format("|".join(suffixes))
+        self.cache_size = cache_size
+        self._memo = {}
         
   
     def normalize(self,s):
         """Heuristics for stripping non-essential UMLS string clutter"""
+        t = self._memo.get(s)
+        if t is None:
+            t = self._normalize(s)
+            if self.cache_size:
+                if len(self._memo) >= self.cache_size:
+                    self._memo.clear()
+                self._memo[s] = t
+        return t
+    
+    
+    def _normalize(self,s):
+        if not self.clutter_rgx.search(s):
+            return self.function(s)
+        
         s = s.replace("--"," ")
-        s = re.sub("[(\[<].+[>)\]]$", "", s)
-        s = re.sub("(\[brand name\]|[,]* NOS)+","", s).strip()
+        s = self.bracket_rgx.sub("", s)
+        s = self.nos_rgx.sub("", s).strip()
         s = s.strip().strip("_").strip(":")
-        s = re.sub("(\[.{1}\])+","", s).strip()
-        s = re.sub("\-RETIRED\-$","",s).strip()
+        s = self.char_rgx.sub("", s).strip()
+        s = self.retired_rgx.sub("",s).strip()
         
         # normalize TTY in [OF,FN]
-        s = re.sub(self.of_fn_rgx,"",s).strip()
+        s = self.suffix_rgx.sub("",s).strip()
         
         # custom normalize function
         s = self.function(s)
@@ -374,76 +720,115 @@ class MetaNorm(TextNorm):
 
 
 class Concept(object):
+    """UMLS concept. All fields (terms, preferred terms and per-SAB 
+    definitions) are fetched in a single query the first time any of 
+    them is accessed and memoized after that."""
     
-    def __init__(self, cui, conn, source_vocab=[]):
-        
+    __slots__ = ["cui", "source_vocab", "conn", "_terms", "_preferred", 
+                 "_definition"]
+    
+    # see docs/concept_schema for an explanation of these term type flags
+    ignore_tty ={x:0 for x in ['OAS','OAP','OAF','OAS','FN','OF',
+                               'MTH_OF','MTH_IS','CSN',
+                               'PCE','N1','AUN','IS']}
+    synset = {x:0 for x in ['SY','SYN','SS','VSY','USY','RSY']}
+    abbrvset = {x:0 for x in ['AA','AB','ACR']}
+    term_types = ",".join(["'%s'" % tty for tty in ignore_tty])
+    
+    def __init__(self, cui, conn, source_vocab=[], atoms=None, definitions=None):
+        """Optionally provide prefetched MRCONSO atoms as (TTY,STR,ISPREF,
+        TS,STT) rows and MRDEF definitions as (SAB,DEF) rows."""
         self.cui = cui
         self.source_vocab = source_vocab
         self.conn = conn
+        self._terms, self._preferred, self._definition = None, None, None
         
-        # see docs/concept_schema for an explanation of these term type flags
-        self.ignore_tty ={x:0 for x in ['OAS','OAP','OAF','OAS','FN','OF',
-                                        'MTH_OF','MTH_IS','CSN',
-                                        'PCE','N1','AUN','IS']}
-        self.synset = {x:0 for x in ['SY','SYN','SS','VSY','USY','RSY']}
-        self.abbrvset = {x:0 for x in ['AA','AB','ACR']}
-        self.term_types = ",".join(["'%s'" % tty for tty in self.ignore_tty])
-        
-        sql = """SELECT TTY,STR,ISPREF FROM MRCONSO 
-                 WHERE CUI='%s' AND TTY NOT IN (%s)"""
-        sql = sql % (self.cui,self.term_types)
-        results = self.conn.query(sql)
-        
-        self._definition = {}
-        self._preferred, self._terms = {},{}
-        
-        for row in results:
-            tty,string,ispref = row
-            self._terms[string] = tty
-            
+        if atoms is not None:
+            self._set_fields(atoms, definitions if definitions else [])
+    
+    
+    @staticmethod
+    def fetch(conn, cuis):
+        """Fetch MRCONSO atoms and MRDEF definitions for a list of CUIs 
+        in one query. Returns {CUI:(atoms,definitions)}"""
+        params = conn.placeholders(len(cuis))
+        sql = """SELECT CUI,'A',TTY,STR,ISPREF,TS,STT FROM MRCONSO 
+                 WHERE CUI IN ({0}) UNION ALL
+                 SELECT CUI,'D',SAB,DEF,NULL,NULL,NULL FROM MRDEF 
+                 WHERE CUI IN ({0})""".format(params)
+        
+        fields = {cui:([],[]) for cui in cuis}
+        for row in conn.query(sql, list(cuis) + list(cuis)):
+            cui,table = row[0:2]
+            if table == 'A':
+                fields[cui][0].append(row[2:])
+            else:
+                fields[cui][1].append(row[2:4])
+        return fields
+    
+    
+    def _set_fields(self, atoms, definitions):
+        terms, preferred, definition = {},[],{}
+        for tty,string,ispref,ts,stt in atoms:
+            if tty not in self.ignore_tty:
+                terms[string] = tty
+            if stt == 'PF' and ispref == 'Y' and ts == 'P':
+                preferred.append(string)
+        
+        for sab,text in definitions:
+            definition.setdefault(sab,[]).append(text)
+        
+        # _terms is assigned last since it marks the concept as loaded
+        # for other threads
+        self._preferred, self._definition = preferred, definition
+        self._terms = terms
+    
+    
+    def _load(self):
+        """Load all fields on first access"""
+        if self._terms is None:
+            self._set_fields(*Concept.fetch(self.conn, [self.cui])[self.cui])
+    
+    
     def __repr__(self):
-        return "[{}] {}".format(self.cui, self.preferred_term()[0])
+        preferred = self.preferred_term()
+        return "[{}] {}".format(self.cui, preferred[0] if preferred else "")
         
                
     def definition(self,source_vocab=[]):
         """There are often multiple definitions conditioned on source vocabulary."""
+        self._load()
         source_vocab = self.source_vocab if not source_vocab else source_vocab
-        sab = "(%s)" % (" OR ".join(["SAB='%s'" % x for x in source_vocab]))
-        sab = "" if not source_vocab else sab + " AND"
-          
-        sql = "SELECT DEF FROM MRDEF WHERE %s CUI='%s'" % (sab,self.cui)
-       
-        results = self.conn.query(sql)
-        return results
+        sabs = source_vocab if source_vocab else self._definition.keys()
+        return [(text,) for sab in sabs for text in self._definition.get(sab,[])]
         
                 
     def preferred_term(self):
         """Preferred name. Don't know what this practically translates too since
         it isn't unique with concepts, atoms or source ontologies."""
-        
-        sql = """SELECT STR FROM MRCONSO WHERE CUI='%s' AND 
-                 STT='PF' AND ISPREF='Y' AND TS='P';""" % self.cui
-        results = self.conn.query(sql)
-        return [x[0] for x in results]
+        self._load()
+        return list(self._preferred)
         
         
     def synonyms(self):
         """UMLS defines several classes of synonymy, use only subset"""
+        self._load()
         return [s for s in self._terms 
                      if self._terms[s] in self.synset]
     
     
     def abbrvs(self):
         """Abbreviations and acronyms"""
+        self._load()
         return [s for s in self._terms 
                      if self._terms[s] in self.abbrvset]
         
         
     def all_terms(self):
         """All unique terms linked to this concept"""
+        self._load()
         return list(set(self._terms))
     
-    
     def print_summary(self):
         """Ugly function to print concept object attributes."""
         print("-----------------------------")
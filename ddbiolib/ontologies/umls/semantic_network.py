@@ -1,6 +1,8 @@
 import os
+import cPickle as pickle
 import networkx as nx
 from ...utils import database
+from .snapshot import RRF_SCHEMA, read_rrf
 
 class SemanticNetwork(object):
     """
@@ -9,16 +11,37 @@ class SemanticNetwork(object):
     
     https://www.ncbi.nlm.nih.gov/books/NBK9679/
 
+    The network is small and fixed per release, so it is loaded once and
+    kept in memory. Sources, in order of preference:
+
+        fname    pickled snapshot written by SemanticNetwork.save()
+        net_dir  directory with the release SRDEF and SRSTR files
+                 (default: the package data directory, if they are there)
+        config   SRDEF and SRSTR database tables, read on first use
+
+    The isa closure, type id <-> name tables and type -> semantic group
+    mapping are precomputed, so subtype expansion is a dictionary lookup.
+
     """
-    def __init__(self, config=None):
+    def __init__(self, config=None, net_dir=None, fname=None):
         
-        self.conn = database.MySqlConn(host=config.host,
-                                       user=config.username, 
-                                       database=config.dbname, 
-                                       password=config.password)
-        self.conn.connect()
+        self.conn = database.connection_pool(config) if config else None
         self._networks = {}
+        self._tables = None
+        self._lookups = {}
         self.abbrv, self.groups = self.__load_sem_groups() # load semantic group definitions
+        self.type_groups = {sty:abbrv for abbrv in self.abbrv
+                            for sty in self.groups[self.abbrv[abbrv]]}
+
+        module_path = os.path.dirname(__file__)
+        net_dir = net_dir if net_dir else "%s/data" % (module_path)
+        if fname:
+            with open(fname, "rb") as f:
+                self._tables = pickle.load(f)
+        elif all(os.path.exists(os.path.join(net_dir, t)) for t in ["SRDEF","SRSTR"]):
+            self._tables = self.__read_net_files(net_dir)
+        elif self.conn is None:
+            raise ValueError("No Semantic Network source (config, net_dir or fname)")
         
         
     def __load_sem_groups(self):
@@ -39,23 +62,57 @@ class SemanticNetwork(object):
         return abbrvs,isas
     
     
+    def __read_net_files(self, net_dir):
+        '''Read SRDEF (RT,UI,STY_RL) and SRSTR (STY_RL1,RL,STY_RL2) rows'''
+        srdef = read_rrf(os.path.join(net_dir, "SRDEF"), len(RRF_SCHEMA["SRDEF"]))
+        srstr = read_rrf(os.path.join(net_dir, "SRSTR"), len(RRF_SCHEMA["SRSTR"]))
+        return {"SRDEF":[tuple(map(str, row[0:3])) for row in srdef if row[0]],
+                "SRSTR":[tuple(map(str, row[0:3])) for row in srstr if row[2]]}
+
+
+    def tables(self):
+        '''SRDEF and SRSTR rows, loaded from the database on first use'''
+        if self._tables is None:
+            srdef = self.conn.query("SELECT RT,UI,STY_RL FROM SRDEF")
+            srstr = self.conn.query("SELECT STY_RL1,RL,STY_RL2 FROM SRSTR")
+            self._tables = {"SRDEF":[tuple(map(str, row)) for row in srdef],
+                            "SRSTR":[tuple(map(str, row)) for row in srstr if row[2]]}
+        return self._tables
+
+
+    def save(self, fname):
+        '''Write a pickled snapshot that loads without a database'''
+        with open(fname, "wb") as f:
+            pickle.dump(self.tables(), f, pickle.HIGHEST_PROTOCOL)
+
+
+    @property
+    def type_ids(self):
+        '''Semantic type name -> TUI'''
+        if "type_ids" not in self._lookups:
+            self._lookups["type_ids"] = {sty:ui for rt,ui,sty in
+                                         self.tables()["SRDEF"] if rt == "STY"}
+        return self._lookups["type_ids"]
+
+
+    @property
+    def type_names(self):
+        '''TUI -> semantic type name'''
+        if "type_names" not in self._lookups:
+            self._lookups["type_names"] = {ui:sty for sty,ui in self.type_ids.items()}
+        return self._lookups["type_names"]
+
+
     def __build_semantic_network(self, relation="isa", directed=True, 
                                  simulate_root=True):
         """Load semantic network structure for a given relation."""
         
-        sql_tmpl = """SELECT C.STY_RL1,C.RL,C.STY_RL2 FROM SRSTR AS C INNER 
-        JOIN SRDEF AS A ON C.STY_RL1=A.STY_RL 
-        INNER JOIN SRDEF AS B ON C.STY_RL2=B.STY_RL 
-        WHERE A.RT='STY' AND B.RT='STY' AND C.RL='%s'"""
-        
-        query = sql_tmpl % (relation)
-        results = self.conn.query(query)
-        
+        types = self.type_ids
         G = nx.DiGraph() if directed else nx.Graph()
         
-        for row in results:
-            child,_,parent = map(str,row)
-            G.add_edge(parent,child)
+        for child,rl,parent in self.tables()["SRSTR"]:
+            if rl == relation and child in types and parent in types:
+                G.add_edge(parent,child)
         
         # Some concept graphs lack a shared root, so add one.
         root_nodes = [node for node in G if not G.predecessors(node)]
@@ -71,4 +128,27 @@ class SemanticNetwork(object):
         if relation not in self._networks:
             self._networks[relation] = self.__build_semantic_network(relation,directed)
         return self._networks[relation]
-    
\ No newline at end of file
+    
+
+    def subtypes(self, semantic_type):
+        """Semantic type and all of its isa descendants"""
+        if "subtypes" not in self._lookups:
+            network = self.graph("isa")
+            self._lookups["subtypes"] = {node:frozenset(nx.descendants(network, node)) |
+                                         frozenset([node]) for node in network}
+        return self._lookups["subtypes"].get(semantic_type, frozenset([semantic_type]))
+
+
+    def supertypes(self, semantic_type):
+        """Semantic type and all of its isa ancestors"""
+        if "supertypes" not in self._lookups:
+            network = self.graph("isa")
+            self._lookups["supertypes"] = {node:frozenset(nx.ancestors(network, node)) |
+                                           frozenset([node]) for node in network}
+        return self._lookups["supertypes"].get(semantic_type, frozenset([semantic_type]))
+
+
+    def semantic_group(self, semantic_type):
+        """Semantic group abbreviation (e.g. DISO) of a type name or TUI"""
+        semantic_type = self.type_names.get(semantic_type, semantic_type)
+        return self.type_groups.get(semantic_type, None)
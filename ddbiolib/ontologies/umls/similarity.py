@@ -0,0 +1,191 @@
+'''
+Concept Similarity
+
+Batched taxonomy similarity measures over a ConceptGraph (edges point
+from parent to child, e.g. concept_graph(relation=["CHD"], compact=True)).
+Node depths and information content (IC) are computed once, and common
+subsumers for a batch of CUI pairs are found with sparse matrix
+operations over the graph's ClosureIndex, so millions of pairs can be
+scored per call.
+
+Measures follow UMLS::Similarity (McInnes et al. 2009):
+
+    path     1 / (number of nodes on the path through the LCS)
+    wup      Wu & Palmer (1994)
+    lch      Leacock & Chodorow (1998)
+    resnik   Resnik (1995), IC of the most informative common subsumer
+    lin      Lin (1998)
+
+Path lengths are measured through the deepest common subsumer, which is
+the exact shortest path in a tree and an approximation in a DAG.
+
+'''
+import os
+import numpy as np
+from scipy.sparse import csr_matrix
+
+MEASURES = ["path", "wup", "lch", "resnik", "lin"]
+
+
+class ConceptSimilarity(object):
+    '''Similarity engine over a ConceptGraph
+
+    Parameters
+    ----------
+    graph : ConceptGraph
+
+    counts : dict, optional
+        Concept frequencies (e.g. from a corpus) used for IC. Counts are
+        add-one smoothed. By default IC is intrinsic, i.e. based on the
+        number of descendants of each concept.
+
+    simulate_root : boolean, optional
+        Add a virtual root above all root concepts (depth 1, IC 0), so
+        every pair has a common subsumer.
+
+    '''
+    def __init__(self, graph, counts=None, simulate_root=True,
+                 depth=None, ic=None):
+        self.graph = graph
+        self.closure = graph.closure()
+        self.simulate_root = simulate_root
+        self.depth = self._depths() if depth is None else depth
+        self.ic = self._information_content(counts) if ic is None else ic
+        self.max_depth = self.depth.max() if len(self.depth) else 0
+
+    def _depths(self):
+        '''Component depth: shortest distance from a root + 1 (+1 again
+        below a simulated root)'''
+        closure, graph = self.closure, self.graph
+        ncomp = len(closure.post)
+        src = closure.component[np.repeat(np.arange(len(graph)), np.diff(graph.indptr))]
+        dst = closure.component[graph.indices]
+        indegree = np.bincount(dst[src != dst], minlength=ncomp)
+        roots = np.where(indegree[closure.component] == 0)[0]
+
+        depth = np.zeros(len(graph), dtype=np.int32)
+        for level, nodes in enumerate(graph.bfs_levels(roots)):
+            depth[nodes] = level + 1
+        comp_depth = np.full(ncomp, np.iinfo(np.int32).max, dtype=np.int32)
+        np.minimum.at(comp_depth, closure.component, depth)
+        return comp_depth + (1 if self.simulate_root else 0)
+
+    def _information_content(self, counts=None):
+        '''IC(c) = -log P(c), where P(c) is the (smoothed) frequency mass
+        of c and all its descendants'''
+        closure = self.closure
+        weights = np.ones(len(self.graph))
+        if counts:
+            idx = self.graph.indices_of(list(counts))
+            freq = np.array(list(counts.values()), dtype=float)
+            weights[idx[idx >= 0]] += freq[idx >= 0]
+        comp_weights = np.bincount(closure.component, weights=weights,
+                                   minlength=len(closure.post))
+
+        # descendants are disjoint post order ranges, so subtree mass is a
+        # difference of prefix sums per interval
+        prefix = np.concatenate([[0.0], np.cumsum(comp_weights[np.argsort(closure.post)])])
+        interval_mass = prefix[closure.ihi + 1] - prefix[closure.ilo]
+        mass = np.add.reduceat(interval_mass, closure.iptr[:-1]) if len(interval_mass) else interval_mass
+        return -np.log(mass / comp_weights.sum())
+
+    def _subsumers(self, a, b, weights):
+        '''Max weight over common subsumers of each (a,b) component pair.
+        Returns 0 where there is no common subsumer.'''
+        uniq, inverse = np.unique(np.concatenate([a, b]), return_inverse=True)
+        A = self.closure.ancestor_matrix(uniq)
+        common = csr_matrix(A[inverse[:len(a)]].multiply(A[inverse[len(a):]]))
+        common.eliminate_zeros()
+        best = np.zeros(len(a))
+        rows = np.where(np.diff(common.indptr) > 0)[0]
+        if len(rows):
+            values = weights[common.indices]
+            best[rows] = np.maximum.reduceat(values, common.indptr[rows])
+        return best
+
+    def score(self, pairs, measure="wup", batch_size=100000):
+        '''Score an array of (CUI1, CUI2) pairs. Pairs with unknown CUIs
+        score NaN.
+
+        Parameters
+        ----------
+        pairs : array
+            Sequence of (CUI1, CUI2) pairs
+
+        measure : string or array
+            One of path, wup, lch, resnik, lin, or a list of measures
+
+        Returns
+        -------
+        array of scores, or dict of arrays if measure is a list
+        '''
+        measures = [measure] if isinstance(measure, basestring) else measure
+        for m in measures:
+            if m not in MEASURES:
+                raise ValueError("Unknown similarity measure '{}'".format(m))
+
+        pairs = np.asarray(pairs)
+        scores = {m:np.full(len(pairs), np.nan) for m in measures}
+        for i in range(0, len(pairs), batch_size):
+            batch = pairs[i:i + batch_size]
+            idx = self.graph.indices_of(batch.ravel()).reshape(-1, 2)
+            known = np.where((idx >= 0).all(axis=1))[0]
+            if not len(known):
+                continue
+            a = self.closure.component[idx[known, 0]]
+            b = self.closure.component[idx[known, 1]]
+            for m, values in self._score(a, b, measures).items():
+                scores[m][i + known] = values
+
+        return scores[measure] if isinstance(measure, basestring) else scores
+
+    def _score(self, a, b, measures):
+        scores = {}
+        if set(measures) & set(["path", "wup", "lch"]):
+            lcs = self._subsumers(a, b, self.depth.astype(float))
+            if self.simulate_root:
+                lcs[lcs == 0] = 1
+            nodes = self.depth[a] + self.depth[b] - 2 * lcs + 1
+            with np.errstate(divide="ignore", invalid="ignore"):
+                if "path" in measures:
+                    scores["path"] = np.where(lcs > 0, 1.0 / nodes, 0.0)
+                if "wup" in measures:
+                    scores["wup"] = 2.0 * lcs / (self.depth[a] + self.depth[b])
+                if "lch" in measures:
+                    scores["lch"] = np.where(lcs > 0, -np.log(nodes / (2.0 * self.max_depth)), 0.0)
+
+        if set(measures) & set(["resnik", "lin"]):
+            mica = self._subsumers(a, b, self.ic)
+            if "resnik" in measures:
+                scores["resnik"] = mica
+            if "lin" in measures:
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    lin = 2.0 * mica / (self.ic[a] + self.ic[b])
+                scores["lin"] = np.where(np.isnan(lin), 1.0, lin)
+        return scores
+
+    def path(self, pairs):
+        return self.score(pairs, "path")
+
+    def wup(self, pairs):
+        return self.score(pairs, "wup")
+
+    def lch(self, pairs):
+        return self.score(pairs, "lch")
+
+    def resnik(self, pairs):
+        return self.score(pairs, "resnik")
+
+    def lin(self, pairs):
+        return self.score(pairs, "lin")
+
+    def save(self, dirname):
+        '''Persist depth and IC tables next to the graph'''
+        np.save(os.path.join(dirname, "similarity.depth.npy"), self.depth)
+        np.save(os.path.join(dirname, "similarity.ic.npy"), self.ic)
+
+    @classmethod
+    def load(cls, dirname, graph, simulate_root=True):
+        depth = np.load(os.path.join(dirname, "similarity.depth.npy"))
+        ic = np.load(os.path.join(dirname, "similarity.ic.npy"))
+        return cls(graph, simulate_root=simulate_root, depth=depth, ic=ic)
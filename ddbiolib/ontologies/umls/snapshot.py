@@ -0,0 +1,149 @@
+'''
+UMLS Snapshot
+
+Build an embedded SQLite copy of a UMLS release directly from the
+Rich Release Format (RRF) files, so Metathesaurus and SemanticNetwork
+can run against a file on local disk instead of a MySQL server.
+
+The Metathesaurus files (MRCONSO.RRF, MRSTY.RRF, ...) live in the META
+directory of a release and the Semantic Network files (SRDEF, SRSTR)
+live in NET. Table and column names follow the NLM load scripts, so
+the existing SQL runs unchanged.
+
+Usage:
+
+    build_snapshot("2014AB/META", "umls.2014AB.db", net_dir="2014AB/NET")
+    config = DatabaseConfig(host=None, username=None,
+                            dbname="umls.2014AB.db", backend="sqlite")
+    meta = Metathesaurus(config)
+
+'''
+import os
+import io
+import sys
+import sqlite3
+import itertools
+from collections import OrderedDict
+
+# column layout of each release file (see the UMLS Reference Manual)
+RRF_SCHEMA = OrderedDict([
+    ("MRCONSO", ["CUI","LAT","TS","LUI","STT","SUI","ISPREF","AUI","SAUI",
+                 "SCUI","SDUI","SAB","TTY","CODE","STR","SRL","SUPPRESS",
+                 "CVF"]),
+    ("MRSTY",   ["CUI","TUI","STN","STY","ATUI","CVF"]),
+    ("MRREL",   ["CUI1","AUI1","STYPE1","REL","CUI2","AUI2","STYPE2","RELA",
+                 "RUI","SRUI","SAB","SL","RG","DIR","SUPPRESS","CVF"]),
+    ("MRDEF",   ["CUI","AUI","ATUI","SATUI","SAB","DEF","SUPPRESS","CVF"]),
+    ("MRSAB",   ["VCUI","RCUI","VSAB","RSAB","SON","SF","SVER","VSTART",
+                 "VEND","IMETA","RMETA","SLC","SCC","SRL","TFR","CFR","CXTY",
+                 "TTYL","ATNL","LAT","CENC","CURVER","SABIN","SSN","SCIT"]),
+    ("SRDEF",   ["RT","UI","STY_RL","STN_RTN","DEF","EX","UN","NH","ABR",
+                 "RIN"]),
+    ("SRSTR",   ["STY_RL1","RL","STY_RL2","LS"]),
+])
+
+# Semantic Network files have no .RRF extension
+RRF_FILENAMES = {"SRDEF":"SRDEF", "SRSTR":"SRSTR"}
+
+RRF_INDICES = {
+    "MRCONSO": [["CUI"],["STR"],["SAB"],["TTY"]],
+    "MRSTY":   [["CUI"],["STY"]],
+    "MRREL":   [["CUI1"],["CUI2"],["REL"],["RELA"]],
+    "MRDEF":   [["CUI"]],
+    "MRSAB":   [["RSAB"]],
+    "SRDEF":   [["STY_RL"]],
+    "SRSTR":   [["RL"]],
+}
+
+
+def _rrf_path(table, search_dirs):
+    fname = RRF_FILENAMES.get(table, "{}.RRF".format(table))
+    for dirname in search_dirs:
+        fpath = os.path.join(dirname, fname)
+        if os.path.exists(fpath):
+            return fpath
+    return None
+
+
+def read_rrf(fpath, ncols, encoding="utf-8"):
+    '''Iterate over rows of a pipe-delimited RRF file. Empty fields
+    are returned as None (NULL)'''
+    with io.open(fpath, "r", encoding=encoding, errors="replace") as f:
+        for line in f:
+            row = line.rstrip("\r\n").split("|")[0:ncols]
+            if len(row) < ncols:
+                row += [u""] * (ncols - len(row))
+            yield tuple(x if x else None for x in row)
+
+
+def build_snapshot(rrf_dir, outfname, net_dir=None, tables=None,
+                   encoding="utf-8", batch_size=50000):
+    '''Load UMLS RRF release files into an indexed SQLite database.
+
+    Parameters
+    ----------
+    rrf_dir : string
+        Directory containing MRCONSO.RRF, MRSTY.RRF, MRREL.RRF, etc.
+
+    outfname : string
+        Output SQLite database file.
+
+    net_dir : string, optional
+        Directory containing the Semantic Network SRDEF and SRSTR files.
+        By default look in rrf_dir and its sibling NET directory.
+
+    tables : array, optional
+        Subset of RRF_SCHEMA tables to load. Default is to load all.
+        Missing tables are created empty.
+
+    '''
+    tables = tables if tables else RRF_SCHEMA.keys()
+    search_dirs = [rrf_dir] + ([net_dir] if net_dir else []) + \
+                  [os.path.join(os.path.dirname(os.path.abspath(rrf_dir)),"NET")]
+
+    # build into a temp file so a failed load never leaves a partial snapshot
+    tmpfname = "{}.tmp".format(outfname)
+    if os.path.exists(tmpfname):
+        os.remove(tmpfname)
+
+    conn = sqlite3.connect(tmpfname)
+    conn.execute("PRAGMA journal_mode=OFF")
+    conn.execute("PRAGMA synchronous=OFF")
+
+    for table in tables:
+        columns = RRF_SCHEMA[table]
+        conn.execute("CREATE TABLE {} ({})".format(table, ",".join(
+                     ["{} TEXT".format(c) for c in columns])))
+
+        fpath = _rrf_path(table, search_dirs)
+        if not fpath:
+            print>>sys.stderr,"Warning: no release file for {}".format(table)
+            continue
+
+        sql = "INSERT INTO {} VALUES ({})".format(table,",".join(["?"] * len(columns)))
+        rows = read_rrf(fpath, len(columns), encoding)
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                break
+            conn.executemany(sql, batch)
+        conn.commit()
+
+    for table in tables:
+        for columns in RRF_INDICES.get(table,[]):
+            name = "IDX_{}_{}".format(table,"_".join(columns))
+            conn.execute("CREATE INDEX {} ON {} ({})".format(name, table, ",".join(columns)))
+
+    conn.execute("ANALYZE")
+    conn.commit()
+    conn.close()
+    os.rename(tmpfname, outfname)
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 3:
+        print>>sys.stderr,"usage: snapshot.py <META dir> <outfile> [NET dir]"
+        sys.exit(1)
+    build_snapshot(sys.argv[1], sys.argv[2],
+                   net_dir=sys.argv[3] if len(sys.argv) > 3 else None)
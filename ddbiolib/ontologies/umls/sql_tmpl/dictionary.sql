@@ -1,4 +1,4 @@
 SELECT C.CUI,TTY,STR,STY 
-FROM (SELECT CUI,TTY,STR FROM MRCONSO WHERE {} AND {}) AS C, 
+FROM (SELECT CUI,TTY,STR FROM MRCONSO WHERE {}) AS C, 
 	 MRSTY AS S 
 WHERE C.CUI=S.CUI AND ({});
\ No newline at end of file
@@ -0,0 +1,574 @@
+'''
+Compiled Term Store
+
+The dictionary caches (data/cache/<term_type>/<sty>.<sab>.txt.bz2, see
+lf_factory.build_umls_dictionaries) are slow to load: every file is
+decompressed and decoded line by line into Python dicts. This module
+compiles a cache directory once into a few flat NumPy arrays that are
+memory-mapped at load time, so startup is near-instant and forked
+workers share the same pages:
+
+    strings    UTF-8 bytes of every unique term, in sorted order
+    offsets    term i is strings[offsets[i]:offsets[i+1]]
+    hashes     CRC32 of each term, sorted, with hash_ids the matching
+               term ids (hash -> term id lookup)
+    member_ids sorted term ids of each (STY,SAB) dictionary, back to back;
+               index.json has the [start,end) range of each dictionary
+
+Usage:
+
+    compile_dictionaries("data/cache/terms/", ignore_case=True)
+    store = TermStore.open("data/cache/terms/", ignore_case=True)
+    "diabetes" in store.termset("disease_or_syndrome", "MSH")
+
+    python -m ddbiolib.ontologies.umls.term_store <rootdir> [--ignore-case] [--normalize]
+
+UmlsDict, UmlsDictionary and UmlsNoiseAwareDict use the compiled store
+of their cache directory when constructed with compiled=True and it is
+up to date: index.json records the path, size and mtime of every source
+file, and a store is ignored once any of them changes (recompile it).
+Otherwise UmlsNoiseAwareDict interns the cache files into an in-memory
+store, while UmlsDict and UmlsDictionary load plain dicts and intern
+them (TermStore.from_dictionaries) only for bulk lookups (semantic
+types, coverage, DictionaryLabeler). Labeling functions over a store
+probe TermIdSets: per-dictionary sets of term ids, sharing one decoded
+term -> id table (TermTable) of the mentions seen so far.
+
+'''
+import os
+import sys
+import bz2
+import glob
+import json
+import zlib
+import hashlib
+import shutil
+import multiprocessing
+import numpy as np
+from itertools import izip
+from scipy.sparse import csr_matrix
+from collections import defaultdict
+from .metathesaurus import MetaNorm
+
+
+def parse_dictionary_fname(fpath):
+    '''(sty, sab) of a cache file named <sty>.<sab>[.abbrv].txt.bz2'''
+    fname = fpath.split("/")[-1].rstrip(".txt.bz2")
+    i = fname.index(".")
+    return fname[0:i], fname[i+1:].rstrip(".abbrv")
+
+
+def read_dictionary_file(fpath, ignore_case=False, normalize=False):
+    '''Decode the (stripped, optionally lowercased and MetaNorm normalized)
+    terms of a cache file. The file is decompressed and decoded as one
+    block; files with invalid UTF-8 fall back to decoding line by line.'''
+    with bz2.BZ2File(fpath,"rb") as f:
+        data = f.read()
+    try:
+        text = data.decode("utf-8")
+        text = text.lower() if ignore_case else text
+        lines = text.split(u"\n")
+    except UnicodeDecodeError:
+        lines = []
+        for line in data.split("\n"):
+            try:
+                line = line.strip().decode('utf-8')
+                lines += [line.lower() if ignore_case else line]
+            except:
+                print>>sys.stderr,"Warning: unicode conversion error"
+    terms = [t for t in (line.strip() for line in lines) if t]
+    return MetaNorm().normalize_many(terms) if normalize else terms
+
+
+def _read_dictionary_file(args):
+    return read_dictionary_file(*args)
+
+
+def read_dictionary_files(fpaths, ignore_case=False, normalize=False, n_jobs=1):
+    '''Read many cache files, by default serially. n_jobs > 1 spreads them 
+    over a process pool of n_jobs workers (None for one per core). Returns
+    the terms of each file, in fpaths order (read lazily when serial, so 
+    only one file is held at a time).'''
+    n_jobs = multiprocessing.cpu_count() if n_jobs is None else n_jobs
+    if min(n_jobs, len(fpaths)) <= 1:
+        return (read_dictionary_file(fpath, ignore_case, normalize) for fpath in fpaths)
+    
+    # largest files first, so no worker is left with a big file at the end
+    order = sorted(range(len(fpaths)), key=lambda i:-os.path.getsize(fpaths[i]))
+    pool = multiprocessing.Pool(min(n_jobs, len(fpaths)))
+    try:
+        results = pool.map(_read_dictionary_file, [(fpaths[i], ignore_case, normalize)
+                                                   for i in order], chunksize=1)
+    finally:
+        pool.terminate()
+    terms = [None] * len(fpaths)
+    for i, t in zip(order, results):
+        terms[i] = t
+    return terms
+
+
+def load_dictionaries(fpaths, ignore_case=False, normalize=False, n_jobs=1):
+    '''Read cache files into plain {sty:{sab:{term:None}}} dictionaries,
+    merging files of the same (STY,SAB)'''
+    d = defaultdict(defaultdict)
+    for fpath, terms in izip(fpaths, read_dictionary_files(fpaths, ignore_case,
+                                                           normalize, n_jobs)):
+        sty,sab = parse_dictionary_fname(fpath)
+        if sty in d and sab in d[sty]:
+            d[sty][sab].update(dict.fromkeys(terms))
+        else:
+            d[sty][sab] = dict.fromkeys(terms)
+    return d
+
+
+def _crc32(term):
+    return zlib.crc32(term) & 0xffffffff
+
+
+def _dictionary_sources(rootdir):
+    '''[path, size, mtime] of every cache file under rootdir, recorded in a
+    compiled store to tell whether it is still up to date'''
+    return [[os.path.abspath(fpath), os.path.getsize(fpath), os.path.getmtime(fpath)]
+            for fpath in sorted(glob.glob("{}*.txt.bz2".format(rootdir)))]
+
+
+def compile_dictionaries(rootdir, outdir=None, ignore_case=False, normalize=False,
+                         n_jobs=1):
+    '''Compile every <sty>.<sab>.txt.bz2 file under rootdir into a
+    TermStore directory (by default TermStore.path(rootdir, ...)).
+
+    Parameters
+    ----------
+    rootdir : string
+        Dictionary cache directory (glob patterns are allowed)
+
+    ignore_case : boolean, optional
+        Lowercase all terms
+
+    normalize : boolean, optional
+        Apply MetaNorm to all terms (after lowercasing)
+
+    n_jobs : int, optional
+        Number of processes reading cache files (default 1, None for one 
+        per core)
+    '''
+    outdir = outdir if outdir else TermStore.path(rootdir, ignore_case, normalize)
+
+    # snapshot the sources first, so files changed while compiling make the
+    # store stale rather than silently newer than recorded
+    sources = _dictionary_sources(rootdir)
+    groups = defaultdict(list)
+    fpaths = [fpath for fpath,size,mtime in sources]
+    for fpath, terms in izip(fpaths, read_dictionary_files(fpaths, ignore_case, 
+                                                           normalize, n_jobs)):
+        groups[parse_dictionary_fname(fpath)].extend(terms)
+
+    store = TermStore.from_groups(groups, ignore_case, normalize)
+    store.sources = sources
+    store.save(outdir)
+    return TermStore.load(outdir)
+
+
+class DictionaryCache(object):
+    '''Dictionary loading shared by UmlsDict, UmlsDictionary and
+    UmlsNoiseAwareDict. Subclasses set rootdir, ignore_case, n_jobs and
+    compiled (and sem_types and source_vocabs, or override _selected), 
+    then load self._dictionary with _load_dictionaries().'''
+
+    def _selected(self, sty, sab):
+        '''Only include specified semantic types and source vocabularies'''
+        return (not self.sem_types or sty in self.sem_types) and \
+               (not self.source_vocabs or sab in self.source_vocabs)
+
+    def _load_dictionaries(self, normalize=False, interned=False):
+        '''{sty:{sab:terms}} of the selected cache files. With 
+        compiled=True, dictionaries are read-only TermSet views of the 
+        compiled (memory-mapped) TermStore of rootdir, if there is an up 
+        to date one (see compile_dictionaries). Otherwise the files are 
+        decoded into plain dicts or, with interned=True, into an in-memory 
+        TermStore (each distinct term stored once) and TermSet views.'''
+        self._store, self._store_normalize = None, normalize
+        if self.compiled:
+            self._store = TermStore.open(self.rootdir, self.ignore_case, normalize)
+
+        if self._store is None:
+            fpaths = [fpath for fpath in glob.glob("{}*.txt.bz2".format(self.rootdir))
+                      if self._selected(*parse_dictionary_fname(fpath))]
+            # decode (and normalize) files, optionally in parallel
+            if not interned:
+                return load_dictionaries(fpaths, self.ignore_case, normalize, self.n_jobs)
+            terms = read_dictionary_files(fpaths, self.ignore_case, normalize, self.n_jobs)
+            self._store = TermStore.from_groups(izip(map(parse_dictionary_fname, fpaths), terms),
+                                                self.ignore_case, normalize)
+
+        d = defaultdict(defaultdict)
+        for sty,sab in self._store.keys():
+            if self._selected(sty, sab):
+                d[sty][sab] = self._store.termset(sty, sab)
+        return d
+
+    @property
+    def store(self):
+        '''TermStore of the loaded dictionaries, used for bulk lookups 
+        (semantic types, coverage, DictionaryLabeler). The compiled store,
+        or interned in memory on first use.'''
+        if self._store is None:
+            self._store = TermStore.from_dictionaries(self._dictionary, self.ignore_case,
+                                                      self._store_normalize)
+        return self._store
+
+    def _lf_dictionary(self, sty, sab):
+        '''Dictionary of a labeling function. LFs probe once per mention, 
+        so TermSets are swapped for a hashed TermIdSet.'''
+        dictionary = self._dictionary[sty][sab]
+        if isinstance(dictionary, TermSet):
+            dictionary = self.store.idset(sty, sab)
+        return dictionary
+
+
+class TermSet(object):
+    '''Read-only, set-like view of one (STY,SAB) dictionary in a TermStore.
+    Supports `in`, len(), iteration and keys() like the dicts it replaces.'''
+
+    def __init__(self, store, ids):
+        self.store = store
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, term):
+        i = self.store.term_id(term)
+        if i < 0:
+            return False
+        j = np.searchsorted(self.ids, i)
+        return j < len(self.ids) and self.ids[j] == i
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return self.store.terms(self.ids)
+
+
+class TermTable(object):
+    '''Decoded term -> id table of a TermStore, shared by its TermIdSets.
+    Terms are added as they are probed (corpora repeat mentions, and 
+    every labeling function probes the same mention in turn), so it grows
+    with the distinct mentions seen rather than with the store. Cleared 
+    once it holds cache_size terms.'''
+
+    def __init__(self, store, cache_size=1000000):
+        self.store = store
+        self.cache_size = cache_size
+        self.ids = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def term_id(self, term):
+        '''Term id, or -1 if the term is not in the store'''
+        i = self.ids.get(term)
+        if i is None:
+            i = int(self.store.term_id(term))
+            if len(self.ids) >= self.cache_size:
+                self.ids.clear()
+            self.ids[term] = i
+        return i
+
+
+class TermIdSet(object):
+    '''Hashed membership test for one (STY,SAB) dictionary in a TermStore,
+    for callers probing it once per mention (labeling functions): the 
+    term is mapped to its id by the store's shared TermTable, then looked
+    up in the dictionary's set of term ids.'''
+
+    def __init__(self, table, ids):
+        self.table = table
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, term):
+        # table hits (the common case) are inlined
+        i = self.table.ids.get(term)
+        if i is None:
+            i = self.table.term_id(term)
+        return i in self.ids
+
+
+class TermStore(object):
+    '''Interned term table. Each distinct term is stored once and every
+    (STY,SAB) dictionary is a sorted array of term ids. Built in memory
+    with from_groups(), or loaded memory-mapped from a compiled cache
+    (see compile_dictionaries).'''
+
+    ARRAYS = ["strings", "offsets", "hashes", "hash_ids", "member_ids"]
+
+    def __init__(self, arrays, index, dirname=None):
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+        self.dirname = dirname
+        self.ignore_case = index["ignore_case"]
+        self.normalize = index["normalize"]
+        self.sources = index.get("sources")
+        self._dictionaries = [(str(sty),str(sab),start,end) for sty,sab,start,end
+                              in index["dictionaries"]]
+        self._index = {(sty,sab):(start,end) for sty,sab,start,end in self._dictionaries}
+        self._inverted_index = None
+        self._term_table = None
+        self._checksums = {}
+
+    @classmethod
+    def from_groups(cls, groups, ignore_case=False, normalize=False):
+        '''Build from {(sty,sab):[terms]}, or an iterable of ((sty,sab),
+        terms) pairs'''
+        items = groups.items() if isinstance(groups, dict) else groups
+        ids, parts = {}, defaultdict(list)
+        for key, terms in items:
+            # intern UTF-8 bytes, encoding each group in one call (terms are
+            # single lines)
+            terms = list(terms)
+            encoded = u"\n".join(terms).encode("utf-8").split("\n") if terms else []
+            if len(encoded) != len(terms):
+                raise ValueError("Terms must not contain newlines")
+            parts[key].append(np.array([ids.setdefault(t, len(ids)) for t in encoded],
+                                       dtype=np.int32))
+            del terms, encoded
+
+        # sort the string table (UTF-8 byte order is code point order) and 
+        # renumber
+        strings = sorted(ids)
+        rank = np.empty(len(strings), dtype=np.int32)
+        rank[[ids[t] for t in strings]] = np.arange(len(strings), dtype=np.int32)
+        del ids
+
+        index, members, start = [], [], 0
+        for sty,sab in sorted(parts):
+            m = np.unique(rank[np.concatenate(parts[(sty,sab)])])
+            index.append([sty, sab, start, start + len(m)])
+            members.append(m)
+            start += len(m)
+
+        offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(t) for t in strings])
+        hashes = np.array([_crc32(t) for t in strings], dtype=np.uint32)
+        order = np.argsort(hashes, kind="mergesort").astype(np.int32)
+
+        arrays = {"strings":np.frombuffer("".join(strings), dtype=np.uint8),
+                  "offsets":offsets, "hashes":hashes[order], "hash_ids":order,
+                  "member_ids":np.concatenate(members) if members else np.array([], np.int32)}
+        return cls(arrays, {"dictionaries":index, "ignore_case":ignore_case,
+                            "normalize":normalize})
+
+    @classmethod
+    def from_dictionaries(cls, d, ignore_case=False, normalize=False):
+        '''Build from loaded {sty:{sab:terms}} dictionaries'''
+        return cls.from_groups([((sty,sab), d[sty][sab]) for sty in d for sab in d[sty]],
+                               ignore_case, normalize)
+
+    def save(self, dirname):
+        # write to a temp directory so readers never see a partial store
+        tmpdir = "{}.tmp".format(dirname.rstrip("/"))
+        if os.path.exists(tmpdir):
+            shutil.rmtree(tmpdir)
+        os.makedirs(tmpdir)
+        for name in self.ARRAYS:
+            np.save(os.path.join(tmpdir, "{}.npy".format(name)), getattr(self, name))
+        with open(os.path.join(tmpdir, "index.json"), "w") as f:
+            json.dump({"dictionaries":self._dictionaries, "ignore_case":self.ignore_case,
+                       "normalize":self.normalize, "sources":self.sources}, f)
+
+        if os.path.exists(dirname):
+            shutil.rmtree(dirname)
+        os.rename(tmpdir, dirname)
+
+    @classmethod
+    def load(cls, dirname, mmap_mode="r"):
+        arrays = {name:np.load(os.path.join(dirname, "{}.npy".format(name)), mmap_mode=mmap_mode)
+                  for name in cls.ARRAYS}
+        with open(os.path.join(dirname, "index.json"), "rU") as f:
+            index = json.load(f)
+        return cls(arrays, index, dirname)
+
+    @staticmethod
+    def path(rootdir, ignore_case=False, normalize=False):
+        '''Default store location for a cache directory, e.g.
+        data/cache/terms/ -> data/cache/terms.lower.dict'''
+        suffix = (".lower" if ignore_case else "") + (".norm" if normalize else "")
+        return "{}{}.dict".format(rootdir.rstrip("/").replace("*", "all"), suffix)
+
+    @classmethod
+    def open(cls, rootdir, ignore_case=False, normalize=False):
+        '''Load the compiled store of a cache directory, or None if there is
+        none or it is stale (a cache file was added, removed or changed 
+        since it was compiled)'''
+        dirname = cls.path(rootdir, ignore_case, normalize)
+        if not os.path.exists(os.path.join(dirname, "index.json")):
+            return None
+        store = cls.load(dirname)
+        # compare as stored (json round trip)
+        if store.sources != json.loads(json.dumps(_dictionary_sources(rootdir))):
+            return None
+        return store
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def term(self, i):
+        return self.strings[self.offsets[i]:self.offsets[i + 1]].tostring().decode("utf-8")
+
+    def terms(self, ids):
+        '''Decode many terms at once (slices of one zero-copy buffer)'''
+        ids = np.asarray(ids, dtype=np.int64)
+        data = self.strings.data
+        return [data[a:b].decode("utf-8") for a,b in
+                zip(self.offsets[ids].tolist(), self.offsets[ids + 1].tolist())]
+
+    def term_id(self, term):
+        '''Term id, or -1 if the term is not in the store'''
+        if isinstance(term, unicode):
+            term = term.encode("utf-8")
+        h = np.uint32(_crc32(term)) # same dtype, or searchsorted copies the array
+        i = np.searchsorted(self.hashes, h)
+        while i < len(self.hashes) and self.hashes[i] == h:
+            j = self.hash_ids[i]
+            if self.strings[self.offsets[j]:self.offsets[j + 1]].tostring() == term:
+                return j
+            i += 1
+        return -1
+
+    def term_table(self):
+        '''TermTable shared by the TermIdSets of the store'''
+        if self._term_table is None:
+            self._term_table = TermTable(self)
+        return self._term_table
+
+    def term_ids(self, terms):
+        '''Vectorized term_id'''
+        terms = [t.encode("utf-8") if isinstance(t, unicode) else t for t in terms]
+        hashes = np.array([_crc32(t) for t in terms], dtype=np.uint32)
+        ids = np.full(len(terms), -1, dtype=np.int64)
+        data = self.strings.data
+        for k, (t, h, i) in enumerate(zip(terms, hashes.tolist(),
+                                          np.searchsorted(self.hashes, hashes).tolist())):
+            while i < len(self.hashes) and self.hashes[i] == h:
+                j = self.hash_ids[i]
+                if data[self.offsets[j]:self.offsets[j + 1]] == t:
+                    ids[k] = j
+                    break
+                i += 1
+        return ids
+
+    def keys(self):
+        '''(sty, sab) of every dictionary'''
+        return sorted(self._index)
+
+    def _inverted(self):
+        '''Inverted index (CSR): the dictionaries containing term i are
+        dicts[ptr[i]:ptr[i+1]], as positions in keys()'''
+        if self._inverted_index is None:
+            lengths = [end - start for sty,sab,start,end in self._dictionaries]
+            owner = np.repeat(np.arange(len(lengths), dtype=np.int32), lengths)
+            order = np.argsort(self.member_ids, kind="mergesort")
+            counts = np.bincount(self.member_ids, minlength=len(self))
+            ptr = np.concatenate([[0], np.cumsum(counts)])
+            self._inverted_index = (ptr, owner[order])
+        return self._inverted_index
+
+    def dictionaries_of(self, term):
+        '''(sty, sab) of every dictionary containing term (one probe)'''
+        i = self.term_id(term)
+        if i < 0:
+            return []
+        ptr, dicts = self._inverted()
+        return [self._dictionaries[j][0:2] for j in dicts[ptr[i]:ptr[i + 1]]]
+
+    def _entries(self, ids):
+        '''(row, dictionary position) of every membership of the given
+        term ids (-1 for unknown terms)'''
+        rows = np.where(ids >= 0)[0]
+        ptr, dicts = self._inverted()
+        starts = ptr[ids[rows]]
+        lengths = ptr[ids[rows] + 1] - starts
+        # positions of every (term, dictionary) entry in dicts
+        entries = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + \
+                  np.arange(lengths.sum())
+        return np.repeat(rows, lengths), dicts[entries]
+
+    def membership_matrix(self, terms, keys=None):
+        '''Sparse boolean len(terms) x len(keys) matrix, True where a term
+        is in a (sty, sab) dictionary. terms are strings or term ids, keys
+        default to keys().'''
+        keys = self.keys() if keys is None else list(keys)
+        column = {key:i for i,key in enumerate(keys)}
+        dict_column = np.array([column.get((sty,sab), -1) for sty,sab,start,end
+                                in self._dictionaries], dtype=np.int64)
+        ids = terms if isinstance(terms, np.ndarray) else self.term_ids(terms)
+        rows, dicts = self._entries(ids)
+        cols = dict_column[dicts]
+        rows, cols = rows[cols >= 0], cols[cols >= 0]
+        return csr_matrix((np.ones(len(rows), dtype=bool), (rows, cols)),
+                          shape=(len(ids), len(keys)))
+
+    def type_matrix(self, terms, keys=None):
+        '''Sparse len(terms) x semantic type matrix, counting the source 
+        vocabularies (SAB) that list each term under each type. Optionally
+        restricted to a subset of (sty, sab) keys.
+
+        Returns
+        -------
+        (csr_matrix, list of semantic types in column order)
+        '''
+        keys = self.keys() if keys is None else list(keys)
+        stys = sorted(set(sty for sty,sab in keys))
+        column = {sty:i for i,sty in enumerate(stys)}
+        # sum dictionary columns into semantic type columns
+        by_type = csr_matrix((np.ones(len(keys), dtype=np.int32),
+                              (np.arange(len(keys)), [column[sty] for sty,sab in keys])),
+                             shape=(len(keys), len(stys)))
+        matrix = self.membership_matrix(terms, keys).astype(np.int32) * by_type
+        return csr_matrix(matrix), stys
+
+    def members(self, sty, sab):
+        start, end = self._index[(sty,sab)]
+        return self.member_ids[start:end]
+
+    def checksum(self, sty, sab):
+        '''SHA-1 digest of a dictionary's terms. Term ids follow sorted term
+        order, so this does not depend on the other dictionaries in the 
+        store.'''
+        if (sty,sab) not in self._checksums:
+            digest = hashlib.sha1()
+            data = self.strings.data
+            ids = self.members(sty, sab)
+            for a,b in zip(self.offsets[ids].tolist(), self.offsets[ids + 1].tolist()):
+                digest.update(data[a:b])
+                digest.update("\n")
+            self._checksums[(sty,sab)] = digest.hexdigest()
+        return self._checksums[(sty,sab)]
+
+    def termset(self, sty, sab):
+        return TermSet(self, self.members(sty, sab))
+
+    def idset(self, sty, sab):
+        return TermIdSet(self.term_table(), frozenset(self.members(sty, sab).tolist()))
+
+    def dictionaries(self, sem_types=[], source_vocabs=[]):
+        '''{sty:{sab:TermSet}} for the selected semantic types and source
+        vocabularies (default all)'''
+        d = defaultdict(defaultdict)
+        for sty,sab in self.keys():
+            if sem_types and sty not in sem_types:
+                continue
+            if source_vocabs and sab not in source_vocabs:
+                continue
+            d[sty][sab] = self.termset(sty, sab)
+        return d
+
+
+if __name__ == "__main__":
+
+    compile_dictionaries(sys.argv[1], ignore_case="--ignore-case" in sys.argv,
+                         normalize="--normalize" in sys.argv, n_jobs=None)
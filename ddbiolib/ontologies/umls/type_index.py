@@ -0,0 +1,144 @@
+'''
+Semantic Type Index
+
+In-memory CUI -> semantic type (STY) index built from a single pass over
+MRSTY. CUIs are interned as a sorted string array (like ConceptGraph
+nodes) and each CUI's types are stored as small integer codes in CSR
+form, so "which of these CUIs have one of these types" is a vectorized
+array lookup instead of an MRCONSO/MRSTY join.
+
+Each CUI also gets a semantic type bitmask (one bit per type, packed in
+uint64 words; 133 types fit in 3 words), so type and semantic group
+filters over large CUI sets are bitwise AND operations.
+
+'''
+import numpy as np
+from array import array
+from .graph import lookup
+
+
+class SemanticTypeIndex(object):
+    '''CUI to semantic type index
+
+    Attributes
+    ----------
+    cuis : array
+        Sorted CUIs. CUI ids are positions in this array.
+
+    indptr, types : array
+        Type codes of CUI i are types[indptr[i]:indptr[i+1]]
+
+    type_names : array
+        Semantic type name of each type code (and bit position)
+
+    groups : dict
+        Semantic group abbreviation (e.g. DISO) -> semantic type names
+
+    '''
+    def __init__(self, cuis, indptr, types, type_names, groups=None):
+        self.cuis = cuis
+        self.indptr = indptr
+        self.types = types
+        self.type_names = type_names
+        self.groups = groups if groups else {}
+        self._codes = {name:i for i,name in enumerate(type_names)}
+        self._bits = None
+
+    @classmethod
+    def from_rows(cls, rows):
+        '''Build from an iterable of (CUI, STY) rows (e.g. a streamed
+        MRSTY query)'''
+        ids, names, codes, type_names = {}, [], {}, []
+        cui, sty = array('l'), array('B')
+        for c, t in rows:
+            if c not in ids:
+                ids[c] = len(names)
+                names.append(c)
+            if t not in codes:
+                codes[t] = len(type_names)
+                type_names.append(t)
+            cui.append(ids[c])
+            sty.append(codes[t])
+
+        nodes = np.array(names, dtype=np.string_) if names else np.array([], dtype="S8")
+        order = np.argsort(nodes, kind="mergesort")
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        cui = rank[np.frombuffer(cui, dtype=np.int64)] if len(cui) else np.array([], np.int64)
+        sty = np.frombuffer(sty, dtype=np.uint8) if len(sty) else np.array([], np.uint8)
+
+        # drop repeated (CUI, STY) rows and sort by CUI
+        pairs = np.unique(cui * 256 + sty)
+        cui, sty = pairs // 256, (pairs % 256).astype(np.uint8)
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(cui, minlength=len(nodes)))])
+        return cls(nodes[order], indptr.astype(np.int64), sty, type_names)
+
+    def __len__(self):
+        return len(self.cuis)
+
+    def __contains__(self, cui):
+        return self.indices_of([cui])[0] >= 0
+
+    def indices_of(self, cuis):
+        '''Vectorized CUI to id lookup, -1 for unknown CUIs'''
+        return lookup(self.cuis, cuis)
+
+    def semantic_types(self, cui):
+        '''Semantic type names of a CUI'''
+        i = self.indices_of([cui])[0]
+        if i < 0:
+            return []
+        return [self.type_names[t] for t in self.types[self.indptr[i]:self.indptr[i + 1]]]
+
+    @property
+    def bits(self):
+        '''(CUIs + 1) x words uint64 semantic type bitmasks. The last row
+        is all zeros and stands in for unknown CUIs (id -1).'''
+        if self._bits is None:
+            nwords = max(1, (len(self.type_names) + 63) // 64)
+            bits = np.zeros((len(self.cuis) + 1, nwords), dtype=np.uint64)
+            rows = np.repeat(np.arange(len(self.cuis)), np.diff(self.indptr))
+            words = (self.types // 64).astype(np.int64)
+            values = np.left_shift(np.uint64(1), (self.types % 64).astype(np.uint64))
+            np.bitwise_or.at(bits, (rows, words), values)
+            self._bits = bits
+        return self._bits
+
+    def type_mask(self, semantic_types):
+        '''Bitmask with the bit of each given semantic type set'''
+        mask = np.zeros(self.bits.shape[1], dtype=np.uint64)
+        for code in [self._codes[t] for t in semantic_types if t in self._codes]:
+            mask[code // 64] |= np.uint64(1) << np.uint64(code % 64)
+        return mask
+
+    def group_mask(self, groups):
+        '''Bitmask of every semantic type in the given semantic groups'''
+        groups = [groups] if isinstance(groups, basestring) else groups
+        return self.type_mask([t for g in groups for t in self.groups[g]])
+
+    def matches(self, cuis, mask):
+        '''Boolean array, True where a CUI has any type bit in mask. Use
+        cuis=None to test every indexed CUI (in id order). Unknown CUIs 
+        are False.'''
+        bits = self.bits[:-1] if cuis is None else self.bits[self.indices_of(cuis)]
+        return (bits & mask).any(axis=1)
+
+    def mask(self, semantic_types):
+        '''Boolean array over CUI ids, True where a CUI has any of the
+        given semantic types'''
+        return self.matches(None, self.type_mask(semantic_types))
+
+    def has_type(self, cuis, semantic_types):
+        '''Vectorized test of each CUI against a set of semantic types.
+        Unknown CUIs are False.'''
+        return self.matches(cuis, self.type_mask(semantic_types))
+
+    def in_group(self, cuis, groups):
+        '''Vectorized test of each CUI against semantic group(s)'''
+        return self.matches(cuis, self.group_mask(groups))
+
+    def select(self, cuis, semantic_types=[], groups=[]):
+        '''Keep only CUIs with one of the given semantic types or groups'''
+        mask = self.type_mask(semantic_types) | self.group_mask(groups)
+        cuis = list(cuis)
+        return [cuis[i] for i in np.where(self.matches(cuis, mask))[0]]
@@ -1,2 +1,3 @@
 from .base import *
-from .database import *
\ No newline at end of file
+from .database import *
+from .cache import *
\ No newline at end of file
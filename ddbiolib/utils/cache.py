@@ -0,0 +1,120 @@
+import os
+import zlib
+import json
+import uuid
+import hashlib
+import cPickle as pickle
+import threading
+from collections import OrderedDict
+
+class LRUCache(object):
+    '''Size-bounded least recently used cache with hit/miss counters.
+    Lookups through get() update the counters, `in` checks do not.
+    Safe to share between threads.'''
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._cache:
+                self.misses += 1
+                return default
+            self.hits += 1
+            value = self._cache.pop(key)
+            self._cache[key] = value
+            return value
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            if key in self._cache:
+                del self._cache[key]
+            elif self.maxsize and len(self._cache) >= self.maxsize:
+                self._cache.popitem(last=False)
+            self._cache[key] = value
+
+    def __contains__(self, key):
+        return key in self._cache
+
+    def __len__(self):
+        return len(self._cache)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        return {"hits":self.hits, "misses":self.misses,
+                "size":len(self._cache), "maxsize":self.maxsize}
+
+
+class DiskCache(object):
+    '''Persistent cache of picklable values, stored as zlib compressed 
+    pickles (one file per key) under rootdir/namespace. Keys are any JSON 
+    serializable value. Entries are grouped by namespace (e.g. a data 
+    release), so changing the namespace invalidates every entry.'''
+    
+    def __init__(self, rootdir, namespace="default", compress=6):
+        self.rootdir = os.path.join(rootdir, namespace)
+        self.namespace = namespace
+        self.compress = compress
+        self.hits = 0
+        self.misses = 0
+        if not os.path.exists(self.rootdir):
+            try:
+                os.makedirs(self.rootdir)
+            except OSError:
+                if not os.path.isdir(self.rootdir):
+                    raise
+    
+    @staticmethod
+    def checksum(key):
+        key = json.dumps(key, sort_keys=True, default=repr)
+        return hashlib.md5(key.encode("utf-8")).hexdigest()
+    
+    def _path(self, key):
+        return os.path.join(self.rootdir, "{}.pkl.z".format(self.checksum(key)))
+    
+    def get(self, key, default=None):
+        fpath = self._path(key)
+        if not os.path.exists(fpath):
+            self.misses += 1
+            return default
+        with open(fpath, "rb") as f:
+            value = pickle.loads(zlib.decompress(f.read()))
+        self.hits += 1
+        return value
+    
+    def __setitem__(self, key, value):
+        # write to a temp file first so readers never see a partial entry
+        fpath = self._path(key)
+        data = zlib.compress(pickle.dumps(value, pickle.HIGHEST_PROTOCOL), self.compress)
+        tmpfname = "{}.{}.tmp".format(fpath, uuid.uuid4().hex)
+        with open(tmpfname, "wb") as f:
+            f.write(data)
+        os.rename(tmpfname, fpath)
+    
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+    
+    def clear(self):
+        for fname in os.listdir(self.rootdir):
+            os.remove(os.path.join(self.rootdir, fname))
+        self.hits = 0
+        self.misses = 0
+    
+    def info(self):
+        return {"hits":self.hits, "misses":self.misses,
+                "size":len(os.listdir(self.rootdir)), "namespace":self.namespace}
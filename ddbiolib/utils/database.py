@@ -1,5 +1,10 @@
-import psycopg2
-import mysql.connector
+import os
+import uuid
+import Queue
+import sqlite3
+import threading
+from functools import partial
+from contextlib import contextmanager
 
 class DatabaseI(object):
     '''Simple database wrapper. This mostly mirrors psycopg2 / mysql.connector 
@@ -8,6 +13,9 @@ class DatabaseI(object):
     
     TODO: check if this is actually required'''
     
+    # bound parameter marker used by the driver (DB-API paramstyle)
+    placeholder = "%s"
+    
     def __init__(self, host, user, database, password="", encoding='latin1'):
         self.host = host
         self.user = user
@@ -25,9 +33,39 @@ class DatabaseI(object):
     def cursor(self):
         raise NotImplementedError()        
 
-    def query(self, sql):
+    def query(self, sql, params=None):
         raise NotImplementedError()    
     
+    def iter_query(self, sql, params=None, batch_size=10000):
+        '''Stream query results, fetching batch_size rows at a time from 
+        an unbuffered/server-side cursor so the full result set is never
+        held in memory. The cursor is closed once the generator is 
+        exhausted or discarded.'''
+        cursor = self._stream_cursor()
+        try:
+            if params:
+                cursor.execute(sql, params)
+            else:
+                cursor.execute(sql)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            self._close_stream(cursor)
+    
+    def _stream_cursor(self):
+        return self.cursor()
+    
+    def _close_stream(self, cursor):
+        cursor.close()
+    
+    def placeholders(self, n):
+        '''Comma separated list of n bound parameter markers'''
+        return ",".join([self.placeholder] * n)
+    
     def __enter__(self):
         return self
     
@@ -43,6 +81,7 @@ class PostgresSqlConn(DatabaseI):
     def connect(self):
         '''Generate a connection to a PostgreSQL database.
         '''
+        import psycopg2
         conn_string = "host='%s' database='%s'" % (self.host, self.database)
         self.conn = psycopg2.connect(conn_string)
         self.conn.set_client_encoding(self.encoding)
@@ -53,6 +92,21 @@ class PostgresSqlConn(DatabaseI):
     def cursor(self): 
         return self.conn.cursor()
     
+    def _stream_cursor(self):
+        # named cursors are server-side in psycopg2
+        return self.conn.cursor(name="ddbiolib_{}".format(uuid.uuid4().hex))
+    
+    def query(self, sql, params=None):
+        cursor = self.conn.cursor()
+        try:
+            if params:
+                cursor.execute(sql, params)
+            else:
+                cursor.execute(sql)
+            return [row for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+    
     def __exit__(self, _type, value, traceback):
         
         if not self.closed():
@@ -68,32 +122,229 @@ class MySqlConn(DatabaseI):
     def connect(self):
         '''Generate a connection to a MySQL database.
         '''
+        import mysql.connector
         #self.conn.set_client_encoding(self.encoding)
         self.conn = mysql.connector.connect(user=self.user, host=self.host,
                                             password=self.password, 
                                             database=self.database)
         
     def closed(self):
-        '''TODO -- don't think this function is correct'''
-        #print(self.conn)
-        #for x in self.conn.__dict__:
-        #    print x
-        return self.conn
+        return self.conn is None or not self.conn.is_connected()
         
     def cursor(self):
         return self.conn.cursor()
     
-    def query(self, sql):
+    def _stream_cursor(self):
+        # unbuffered cursors read rows from the server as they are fetched
+        return self.conn.cursor(buffered=False)
+    
+    def _close_stream(self, cursor):
+        # closing an unbuffered cursor with unread rows raises "Unread 
+        # result found" (hiding any error raised while streaming) and 
+        # leaves the connection unusable, so drain the rows first
+        try:
+            self.conn.consume_results()
+        finally:
+            cursor.close()
+    
+    def query(self, sql, params=None):
         cursor = self.conn.cursor()
-        cursor.execute(sql)
+        if params:
+            cursor.execute(sql, params)
+        else:
+            cursor.execute(sql)
         return [row for row in cursor.fetchall()]
         
     def __exit__(self, _type, value, traceback):  
         if not self.closed():
-            print("exiting")
             self.conn.close()
+            self.conn = None
        
     def __del__(self):        
         if not self.closed():
             self.conn.close()
-            
+            self.conn = None
+
+
+class SqliteConn(DatabaseI):
+    '''Embedded SQLite database. Here `database` is the path of the 
+    database file; host, user and password are ignored.'''
+    
+    placeholder = "?"
+    
+    def connect(self):
+        '''Open a connection to a local SQLite database file.
+        '''
+        if not self.database or not os.path.exists(self.database):
+            raise IOError("SQLite database not found: {}".format(self.database))
+        # pooled connections may be handed to a different thread than 
+        # the one that opened them (but never to two threads at once)
+        self.conn = sqlite3.connect(self.database, check_same_thread=False)
+        
+    def closed(self):
+        return self.conn is None
+        
+    def cursor(self):
+        return self.conn.cursor()
+    
+    def query(self, sql, params=None):
+        cursor = self.conn.cursor()
+        if params:
+            cursor.execute(sql, params)
+        else:
+            cursor.execute(sql)
+        return [row for row in cursor.fetchall()]
+        
+    def __exit__(self, _type, value, traceback):  
+        if not self.closed():
+            self.conn.close()
+            self.conn = None
+       
+    def __del__(self):        
+        if not self.closed():
+            self.conn.close()
+            self.conn = None
+
+
+BACKENDS = {"mysql":MySqlConn, "postgres":PostgresSqlConn, "sqlite":SqliteConn}
+
+def _backend(config):
+    backend = getattr(config, "backend", "mysql") or "mysql"
+    if backend not in BACKENDS:
+        raise ValueError("Unknown database backend '{}'".format(backend))
+    return BACKENDS[backend]
+
+def connect(config):
+    '''Open a database connection for a DatabaseConfig-style object 
+    (host, username, dbname, password, backend)'''
+    conn = _backend(config)(host=config.host, user=config.username, 
+                            database=config.dbname, password=config.password)
+    conn.connect()
+    return conn
+
+
+class ConnectionPool(object):
+    '''Thread-safe pool of database connections. Connections are opened 
+    on demand, up to maxsize, and each one is used by a single thread at 
+    a time. The pool exposes the same query interface as DatabaseI, so it 
+    can be used anywhere a connection is expected.'''
+    
+    def __init__(self, factory, maxsize=8, placeholder="%s"):
+        self.factory = factory
+        self.maxsize = maxsize
+        self.placeholder = placeholder
+        self._idle = Queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._size = 0
+        
+    def acquire(self, timeout=None):
+        '''Take an idle connection, opening a new one if the pool is not 
+        full, otherwise block until one is released'''
+        try:
+            return self._idle.get_nowait()
+        except Queue.Empty:
+            pass
+        with self._lock:
+            opened = self._size < self.maxsize
+            if opened:
+                self._size += 1
+        if not opened:
+            return self._idle.get(timeout=timeout)
+        try:
+            return self.factory()
+        except:
+            with self._lock:
+                self._size -= 1
+            raise
+    
+    def release(self, conn):
+        with self._lock:
+            shrink = self._size > self.maxsize
+            if shrink:
+                self._size -= 1
+        if shrink:
+            conn.__exit__(None, None, None)
+        else:
+            self._idle.put(conn)
+    
+    def discard(self, conn):
+        '''Close a connection that may be left in an unusable state 
+        instead of returning it to the pool'''
+        with self._lock:
+            self._size -= 1
+        try:
+            conn.__exit__(None, None, None)
+        except Exception:
+            pass
+    
+    def resize(self, maxsize):
+        '''Change the pool size. When shrinking, connections over the new 
+        size are closed as they become idle.'''
+        with self._lock:
+            self.maxsize = maxsize
+        while True:
+            with self._lock:
+                if self._size <= self.maxsize:
+                    break
+            try:
+                conn = self._idle.get_nowait()
+            except Queue.Empty:
+                break
+            with self._lock:
+                self._size -= 1
+            conn.__exit__(None, None, None)
+    
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+    
+    def query(self, sql, params=None):
+        with self.connection() as conn:
+            return conn.query(sql, params)
+    
+    def iter_query(self, sql, params=None, batch_size=10000):
+        '''The connection is held until the generator is exhausted or 
+        discarded. A stream that raises or is closed early may leave the
+        connection mid-result, so it is discarded rather than released.'''
+        conn = self.acquire()
+        try:
+            for row in conn.iter_query(sql, params, batch_size):
+                yield row
+        except BaseException:
+            self.discard(conn)
+            raise
+        self.release(conn)
+    
+    def placeholders(self, n):
+        return ",".join([self.placeholder] * n)
+    
+    def close(self):
+        '''Close idle connections'''
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except Queue.Empty:
+                break
+            with self._lock:
+                self._size -= 1
+            conn.__exit__(None, None, None)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def connection_pool(config, maxsize=None):
+    '''Return the process-wide connection pool for this config, creating 
+    it on first use (default size 8). Objects built from the same config 
+    share a pool; an explicit maxsize resizes the shared pool.'''
+    with _pools_lock:
+        if config not in _pools:
+            _pools[config] = ConnectionPool(partial(connect, config), maxsize or 8,
+                                            _backend(config).placeholder)
+        elif maxsize and maxsize != _pools[config].maxsize:
+            _pools[config].resize(maxsize)
+        return _pools[config]
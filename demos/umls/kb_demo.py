@@ -5,8 +5,7 @@ computing some concept similarity measures
 '''
 from __future__ import print_function
 
-import networkx as nx
-from ddbiolib.ontologies.umls import Metathesaurus
+from ddbiolib.ontologies.umls import Metathesaurus, ConceptSimilarity
 from ddbiolib.ontologies.umls.config import DatabaseConfig
 
 def pprint_path(path, ontology):
@@ -35,9 +34,15 @@ c2 = meta.concept(cui="C0446516")  # Arm
 c2.print_summary()
 
 # build CUI-level concept graph using MeSH (Medical Subject Headings)
-cui_graph = meta.concept_graph(level="CUI",source_vocab=["MSH","RXNORM","SNOMEDCT-US"])
-
-# shortest path connecting concepts
-# Finger and Arm
-path = nx.shortest_path(nx.Graph(cui_graph), c1.cui, c2.cui)
-pprint_path(path,meta)
+cui_graph = meta.concept_graph(level="CUI",source_vocab=["MSH","RXNORM","SNOMEDCT-US"],
+                               compact=True)
+
+# lowest common ancestors of Finger and Arm
+pprint_path(cui_graph.closure().lowest_common_ancestors(c1.cui, c2.cui), meta)
+
+# batched similarity scores for concept pairs
+sim = ConceptSimilarity(cui_graph)
+pairs = [(c1.cui, c2.cui), (cui1, cui2)]
+scores = sim.score(pairs, measure=["path","wup","lch","resnik","lin"])
+for measure in scores:
+    print(measure, scores[measure])
@@ -0,0 +1,450 @@
+import os, sys, bz2, shutil, tempfile, unittest
+from multiprocessing.pool import ThreadPool
+import numpy as np
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+from ddbiolib.ontologies.umls import *
+from ddbiolib.utils import database
+
+# tiny synthetic UMLS release (pipe-delimited, trailing pipe like real RRF)
+RRF_FILES = {
+    "MRCONSO.RRF": [
+        "C0001|ENG|P|L1|PF|S1|Y|A1||||MSH|MH|D1|Diabetes Mellitus|0|N||",
+        "C0001|ENG|S|L2|VO|S2|Y|A2||||MSH|SY|D1|Sugar diabetes|0|N||",
+        "C0001|ENG|S|L3|PF|S3|Y|A3||||MSH|AB|D1|DM|0|N||",
+        "C0002|ENG|P|L4|PF|S4|Y|A4||||MSH|MH|D2|Type 1 Diabetes|0|N||",
+        "C0002|ENG|P|L4|PF|S5|N|A5||||SNOMEDCT_US|FN|1|Type 1 diabetes (disorder)|0|N||",
+        "C0003|ENG|P|L5|PF|S6|Y|A6||||MSH|MH|D3|Insulin|0|N||",
+        "C0004|ENG|P|L6|PF|S7|Y|A7||||SNOMEDCT_US|PT|2|Neoplasm|0|N||",
+    ],
+    "MRSTY.RRF": [
+        "C0001|T047|B2.2.1.2.1|Disease or Syndrome|AT1||",
+        "C0002|T047|B2.2.1.2.1|Disease or Syndrome|AT2||",
+        "C0003|T121|A1.4.1.1.1|Pharmacologic Substance|AT3||",
+        "C0004|T046|B2.2.1.2|Pathologic Function|AT4||",
+    ],
+    "MRREL.RRF": [
+        "C0001|A1|AUI|CHD|C0002|A4|AUI||R1||MSH|MSH|||N||",
+        "C0004|A7|AUI|CHD|C0001|A1|AUI||R2||MSH|MSH|||N||",
+        "C0002|A4|AUI|RO|C0003|A6|AUI|may_treat|R3||MSH|MSH|||N||",
+    ],
+    "MRDEF.RRF": [
+        "C0001|A1|AT5||MSH|A metabolic disease.|N||",
+        "C0001|A2|AT6||NCI|Chronically elevated blood glucose.|N||",
+    ],
+    "MRSAB.RRF": [
+        "C1|C2|MSH2014|MSH|Medical Subject Headings|MSH|2014|||||||0|||||ENG|UTF-8|Y|Y||",
+    ],
+    "SRDEF": [
+        "STY|T071|Entity|A|def||||||",
+        "STY|T046|Pathologic Function|B2.2.1.2|def||||||",
+        "STY|T047|Disease or Syndrome|B2.2.1.2.1|def||||||",
+        "STY|T103|Chemical|A1.4.1|def||||||",
+        "STY|T121|Pharmacologic Substance|A1.4.1.1.1|def||||||",
+        "RL|T186|isa|H|def||||||",
+    ],
+    "SRSTR": [
+        "Pathologic Function|isa|Entity|D|",
+        "Disease or Syndrome|isa|Pathologic Function|D|",
+        "Chemical|isa|Entity|D|",
+        "Pharmacologic Substance|isa|Chemical|D|",
+    ],
+}
+
+
+def build_test_snapshot(rootdir):
+    '''Write the synthetic release to rootdir and load it into SQLite'''
+    for fname, lines in RRF_FILES.items():
+        with open(os.path.join(rootdir, fname), "w") as f:
+            f.write("\n".join(lines) + "\n")
+    outfname = os.path.join(rootdir, "umls.db")
+    build_snapshot(rootdir, outfname)
+    return DatabaseConfig(host=None, username=None, dbname=outfname,
+                          backend="sqlite")
+
+
+class TestUmlsSnapshot(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.rootdir = tempfile.mkdtemp()
+        cls.config = build_test_snapshot(cls.rootdir)
+        cls.meta = Metathesaurus(cls.config)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.rootdir)
+
+    def test_iter_query(self):
+        rows = self.meta.conn.iter_query("SELECT CUI FROM MRSTY WHERE STY=?", 
+                                         ["Disease or Syndrome"], batch_size=1)
+        self.assertEqual(sorted(rows), [("C0001",), ("C0002",)])
+
+    def test_dictionary(self):
+        terms = self.meta.dictionary("Pathologic Function", term_types=["MH","PT","SY","FN"])
+        self.assertEqual(sorted(terms), ["Diabetes Mellitus", "Neoplasm",
+                                         "Sugar diabetes", "Type 1 Diabetes",
+                                         "Type 1 diabetes"])
+        cuis = self.meta.dictionary("Disease or Syndrome", cui_dict=True)
+        self.assertEqual(sorted(cuis), ["C0001", "C0002"])
+
+    def test_concept(self):
+        concept = self.meta.concept("C0001")
+        self.assertIsNone(concept._terms)
+        self.assertEqual(repr(concept), "[C0001] Diabetes Mellitus")
+        self.assertEqual(concept.preferred_term(), ["Diabetes Mellitus"])
+        self.assertEqual(concept.abbrvs(), ["DM"])
+        self.assertEqual(len(concept.definition()), 2)
+        self.assertEqual(len(concept.definition(source_vocab=["NCI"])), 1)
+
+    def test_concepts(self):
+        meta = Metathesaurus(self.config, cache_size=2)
+        concepts = meta.concepts(["C0001", "C0002", "C0003", "C0001"])
+        self.assertEqual(sorted(concepts), ["C0001", "C0002", "C0003"])
+        self.assertEqual(concepts["C0001"].preferred_term(), ["Diabetes Mellitus"])
+        self.assertEqual(concepts["C0001"].abbrvs(), ["DM"])
+        self.assertEqual(concepts["C0001"].definition(source_vocab=["NCI"]),
+                         [("Chronically elevated blood glucose.",)])
+        self.assertEqual(concepts["C0003"].definition(), [])
+        # cache is bounded, so the least recently loaded concept was evicted
+        self.assertEqual(meta.cache_info()["size"], 2)
+        meta.concepts(["C0001", "C0002", "C0003"])
+        meta.concept("C0003")
+        self.assertEqual(meta.cache_info()["hits"], 3)
+
+    def test_disk_cache(self):
+        cache_dir = os.path.join(self.rootdir, "cache")
+        meta = Metathesaurus(self.config, cache_dir=cache_dir)
+        terms = meta.dictionary("Disease or Syndrome")
+        graph = meta.concept_graph(relation=["CHD"])
+        self.assertEqual(meta.disk_cache.info()["misses"], 3)
+        # a new process would reload results from disk
+        meta = Metathesaurus(self.config, cache_dir=cache_dir)
+        self.assertEqual(sorted(meta.dictionary("Disease or Syndrome")), sorted(terms))
+        self.assertEqual(sorted(meta.concept_graph(relation=["CHD"]).edges()), 
+                         sorted(graph.edges()))
+        self.assertEqual(meta.disk_cache.info()["hits"], 2)
+        self.assertTrue(meta.disk_cache.namespace.startswith("umls.db."))
+
+    def test_thread_pool(self):
+        meta = Metathesaurus(self.config)
+        self.assertIs(meta.conn, meta.semantic_network.conn)
+        cuis = ["C0001", "C0002", "C0003", "C0004"] * 25
+        pool = ThreadPool(8)
+        terms = pool.map(lambda cui:meta.concept(cui).preferred_term(), cuis)
+        matches = pool.map(meta.match_concepts, ["Insulin", "DM"] * 50)
+        pool.close()
+        self.assertEqual(terms[0:4], [["Diabetes Mellitus"], ["Type 1 Diabetes"],
+                                      ["Insulin"], ["Neoplasm"]])
+        self.assertEqual(matches[0:2], [["C0003"], ["C0001"]])
+        self.assertTrue(meta.conn._size <= meta.conn.maxsize)
+        self.assertEqual(Metathesaurus(self.config, pool_size=2).conn.maxsize, 2)
+        self.assertTrue(meta.conn._size <= 2)
+        
+        # an abandoned stream closes its connection instead of releasing it
+        pool = database.ConnectionPool(lambda:database.connect(self.config), 2)
+        rows = pool.iter_query("SELECT CUI FROM MRCONSO")
+        next(rows)
+        rows.close()
+        self.assertEqual((pool._size, pool._idle.qsize()), (0, 0))
+        self.assertTrue(len(list(pool.iter_query("SELECT CUI FROM MRCONSO"))) > 1)
+        self.assertEqual((pool._size, pool._idle.qsize()), (1, 1))
+
+    def test_match_concepts_many(self):
+        matches = self.meta.match_concepts_many(["Insulin", "DM", "Crohn's", "Insulin"])
+        self.assertEqual(matches, {"Insulin":["C0003"], "DM":["C0001"], "Crohn's":[]})
+        matches = self.meta.match_concepts_many(["type 1", "Diabetes"], 
+                                                match_substring=True, batch_size=1)
+        self.assertEqual(matches, {"type 1":["C0002"], "Diabetes":["C0001"]})
+        matches = self.meta.match_concepts_many(["Type 1 Diabetes"], source_vocab=["SNOMEDCT_US"])
+        self.assertEqual(matches, {"Type 1 Diabetes":[]})
+        self.assertEqual(self.meta.match_concepts("Insulin"), ["C0003"])
+
+    def test_concept_graph(self):
+        G = self.meta.concept_graph(relation=["CHD"])
+        self.assertEqual(sorted(G.edges()), [("C0001","C0002"), ("C0004","C0001")])
+
+    def test_compact_concept_graph(self):
+        G = self.meta.concept_graph(relation=["CHD","RO"], compact=True)
+        self.assertEqual(len(G), 4)
+        self.assertEqual(G.number_of_edges(), 3)
+        self.assertEqual(G.successors("C0004"), ["C0001"])
+        self.assertEqual(G.predecessors("C0002"), ["C0001"])
+        self.assertEqual(G.bfs("C0004"), ["C0004", "C0001", "C0002", "C0003"])
+        self.assertEqual(G.bfs("C0002", reverse=True), ["C0002", "C0001", "C0004"])
+        self.assertEqual(G.out_edges("C0002"), [("C0002", "C0003", "RO", "may_treat")])
+        nxG = self.meta.concept_graph(relation=["CHD","RO"])
+        self.assertEqual(sorted(G.to_networkx().edges(data=True)), 
+                         sorted(nxG.edges(data=True)))
+        G.save(os.path.join(self.rootdir, "graph"))
+        H = ConceptGraph.load(os.path.join(self.rootdir, "graph"), mmap_mode="r")
+        self.assertEqual(H.bfs("C0004"), G.bfs("C0004"))
+
+    def test_closure_index(self):
+        # multi-parent DAG with a cycle (C5 <-> C6)
+        edges = [("C1","C2"), ("C1","C3"), ("C2","C4"), ("C3","C4"), 
+                 ("C4","C5"), ("C5","C6"), ("C6","C5"), ("C3","C7")]
+        G = ConceptGraph.from_edges([(a, b, "CHD", None) for a, b in edges])
+        C = G.closure()
+        self.assertTrue(C.is_ancestor("C1", "C6"))
+        self.assertTrue(C.is_ancestor("C6", "C5"))
+        self.assertFalse(C.is_ancestor("C2", "C7"))
+        self.assertEqual(sorted(C.descendants("C3")), ["C4", "C5", "C6", "C7"])
+        self.assertEqual(sorted(C.ancestors("C4")), ["C1", "C2", "C3"])
+        self.assertEqual(sorted(C.lowest_common_ancestors("C4", "C7")), ["C3"])
+        self.assertEqual(sorted(C.lowest_common_ancestors("C2", "C5")), ["C2"])
+        G.save(os.path.join(self.rootdir, "closure"))
+        H = ConceptGraph.load(os.path.join(self.rootdir, "closure"), mmap_mode="r")
+        self.assertEqual(sorted(H.closure().descendants("C3")), ["C4", "C5", "C6", "C7"])
+
+    def test_similarity(self):
+        edges = [("R","A"), ("R","B"), ("A","A1"), ("A","A2"), ("B","B1"), 
+                 ("A2","X"), ("B1","X"), ("Q","Q1")]
+        G = ConceptGraph.from_edges([(a, b, "CHD", None) for a, b in edges])
+        sim = ConceptSimilarity(G)
+        pairs = [("A1","A2"), ("X","A"), ("A1","Q1"), ("A1","A1"), ("A1","ZZ")]
+        scores = sim.score(pairs, measure=["path","wup","resnik","lin"])
+        self.assertTrue(np.allclose(scores["path"][0:4], [1/3., 1/3., 1/6., 1.]))
+        self.assertTrue(np.allclose(scores["wup"][0:4], [0.75, 0.75, 2/7., 1.]))
+        self.assertTrue(np.allclose(scores["resnik"][0:3], [np.log(9/4.), np.log(9/4.), 0]))
+        self.assertEqual(scores["lin"][3], 1.0)
+        self.assertTrue(np.isnan(scores["wup"][4]))
+        self.assertTrue(np.allclose(sim.lch([("A1","A2")]), [-np.log(3/10.)]))
+
+    def test_relations_between(self):
+        pairs = [("C0001","C0002"), ("C0002","C0003"), ("C0003","C0002"), ("C0001","C9999")]
+        expected = {("C0001","C0002"):[("CHD",None)], ("C0002","C0003"):[("RO","may_treat")],
+                    ("C0003","C0002"):[], ("C0001","C9999"):[]}
+        self.assertEqual(self.meta.relations_between(pairs, use_index=False, batch_size=2), expected)
+        self.assertEqual(self.meta.relations_between(pairs), expected)
+        self.assertEqual(self.meta.relations_between_cui("C0002","C0003"), [("RO","may_treat")])
+        meta = Metathesaurus(self.config)
+        self.assertEqual(meta.relations_between(pairs), expected)
+        self.assertNotIn("relations_", meta._networks)
+        self.assertEqual(meta.relations_between(pairs, index_min_pairs=1), expected)
+        self.assertIn("relations_", meta._networks)
+        rels = self.meta.relations_on_cui("C0003")
+        self.assertEqual([r[0] for r in rels], ["R3"])
+
+    def test_relations(self):
+        rels = self.meta.relations("Chemical", "Disease or Syndrome", "may_treat")
+        self.assertEqual(rels, [("C0003", "C0002")])
+        rels = self.meta.relations(["Chemical", "Entity"], "Pathologic Function",
+                                   ["may_treat", "isa"])
+        self.assertEqual(rels, [("C0003", "C0002")])
+        self.assertEqual(self.meta.relations("Chemical", "Chemical", "may_treat"), [])
+
+    def test_semantic_network(self):
+        network = SemanticNetwork(net_dir=self.rootdir)
+        self.assertEqual(network.subtypes("Chemical"),
+                         frozenset(["Chemical", "Pharmacologic Substance"]))
+        self.assertEqual(network.type_names["T047"], "Disease or Syndrome")
+        self.assertEqual(network.semantic_group("T047"), "DISO")
+        fname = os.path.join(self.rootdir, "semantic_network.pkl")
+        self.meta.semantic_network.save(fname)
+        network = SemanticNetwork(fname=fname)
+        self.assertEqual(sorted(network.graph("isa").edges()),
+                         sorted(self.meta.semantic_network.graph("isa").edges()))
+        self.assertIn("Pathologic Function", network.supertypes("Disease or Syndrome"))
+
+    def test_meta_norm(self):
+        norm = MetaNorm(function=lambda x:x.lower(), cache_size=2)
+        strings = ["Diabetes mellitus, NOS", "Neoplasm (disorder)", "Insulin",
+                   "Aspirin [brand name]", "_Heart attack:", "Old term-RETIRED-"]
+        expected = ["diabetes mellitus", "neoplasm", "insulin", "aspirin",
+                    "heart attack", "old term"]
+        self.assertEqual(norm.normalize_many(strings), expected)
+        self.assertEqual(norm.normalize_many(strings * 3, n_jobs=2, chunksize=4), expected * 3)
+        self.assertLessEqual(len(norm._memo), 2)
+
+    def test_semantic_type_index(self):
+        types = self.meta.semantic_type_index()
+        self.assertEqual(types.semantic_types("C0003"), ["Pharmacologic Substance"])
+        mask = types.has_type(["C0001", "C0004", "C9999"], ["Disease or Syndrome"])
+        self.assertEqual(mask.tolist(), [True, False, False])
+        self.assertEqual(types.in_group(["C0001", "C0003"], "DISO").tolist(), [True, False])
+        self.assertEqual(types.select(["C0004", "C0003", "C0002"], groups=["CHEM", "DISO"]),
+                         ["C0004", "C0003", "C0002"])
+        self.assertEqual(types.select(["C0004", "C0003"], ["Pharmacologic Substance"]), ["C0003"])
+
+
+# cached dictionary files, data/cache/<term_type>/<sty>.<sab>.txt.bz2
+DICT_FILES = {
+    "disease_or_syndrome.MSH.txt.bz2": [u"Diabetes Mellitus, NOS", u"Type 1 Diabetes"],
+    "disease_or_syndrome.SNOMEDCT_US.txt.bz2": [u"Type 1 diabetes (disorder)"],
+    "pharmacologic_substance.MSH.txt.bz2": [u"Insulin", u"Aspirin [brand name]"],
+}
+
+
+class Mention(object):
+    '''Minimal candidate mention for labeling functions'''
+    def __init__(self, text):
+        self.text = text
+        self.sentence = {"text":u"No {} given".format(text)}
+        self.sent_char_start = 3
+        self.sent_char_end = 3 + len(text) - 1
+
+    def get_attrib_tokens(self, name):
+        return self.text.split()
+
+
+class TestUmlsDict(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.rootdir = os.path.join(cls.tmpdir, "terms/")
+        os.makedirs(cls.rootdir)
+        for fname, lines in DICT_FILES.items():
+            with bz2.BZ2File(os.path.join(cls.rootdir, fname), "wb") as f:
+                f.write(u"\n".join(lines).encode("utf-8"))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def test_umls_dict(self):
+        d = UmlsDict("terms", rootdir=self.rootdir, ignore_case=True)
+        self.assertIsInstance(d._dictionary["disease_or_syndrome"]["MSH"], dict)
+        self.assertEqual(sorted(d["Disease or Syndrome"]), [u"diabetes mellitus, nos",
+                         u"type 1 diabetes", u"type 1 diabetes (disorder)"])
+        self.assertIs(d["Disease or Syndrome"], d["disease_or_syndrome"]) # memoized
+        self.assertIs(d.get_dictionary(), d.get_dictionary())
+        self.assertEqual(len(d.get_dictionary()), 5)
+        self.assertEqual(len(list(d)), 5)
+
+        d.normalizer = MetaNorm()
+        self.assertEqual(sorted(d["Disease or Syndrome"]), [u"diabetes mellitus, nos",
+                         u"type 1 diabetes"])
+        self.assertEqual(sorted(d.get_dictionary(["Pharmacologic Substance"])),
+                         [u"aspirin", u"insulin"])
+
+        class Stem(object): # duck-typed normalizer, no normalize_many
+            def apply(self, s):
+                return s.split()[0]
+        d.normalizer = Stem()
+        self.assertEqual(sorted(d["Disease or Syndrome"]), [u"diabetes", u"type"])
+
+    def test_term_store(self):
+        raw = UmlsDictionary("terms", rootdir=self.rootdir, ignore_case=True)
+        pooled = UmlsDictionary("terms", rootdir=self.rootdir, ignore_case=True, n_jobs=2)
+        self.assertEqual(pooled.get_dictionary(), raw.get_dictionary())
+        matrix, stys = raw.sem_type_matrix([u"type 1 diabetes", u"insulin", u"unknown"])
+        self.assertEqual(stys, ["disease_or_syndrome", "pharmacologic_substance"])
+        self.assertEqual(matrix.toarray().tolist(), [[1, 0], [0, 1], [0, 0]])
+
+        terms = [u"Type 1 Diabetes", u"insulin", u"type 1 diabetes (disorder)", u"unknown"]
+        self.assertEqual(raw.coverage(terms), [(("disease_or_syndrome","MSH"), 0.25),
+                         (("disease_or_syndrome","SNOMEDCT_US"), 0.25),
+                         (("pharmacologic_substance","MSH"), 0.25)])
+        stats = raw.source_coverage(terms + [u"insulin"])
+        self.assertEqual(stats["greedy"][0], (("pharmacologic_substance","MSH"), 0.4, 0.4))
+        self.assertEqual([g[0] for g in stats["greedy"]][1:], [("disease_or_syndrome","MSH"),
+                         ("disease_or_syndrome","SNOMEDCT_US")])
+        self.assertAlmostEqual(stats["greedy"][-1][2], 0.8)
+        self.assertEqual(stats["overlap"].toarray().tolist(), [[1, 0, 0], [0, 1, 0], [0, 0, 2]])
+        self.assertIsInstance(raw._dictionary["disease_or_syndrome"]["MSH"], dict)
+        store = compile_dictionaries(self.rootdir, ignore_case=True)
+        self.assertEqual(store.dirname, os.path.join(self.tmpdir, "terms.lower.dict"))
+        self.assertEqual(len(store), 5)
+        self.assertIsInstance(UmlsDictionary("terms", rootdir=self.rootdir, ignore_case=True)
+                              ._dictionary["disease_or_syndrome"]["MSH"], dict)
+        d = UmlsDictionary("terms", rootdir=self.rootdir, ignore_case=True, compiled=True)
+        self.assertIsInstance(d._dictionary["disease_or_syndrome"]["MSH"], TermSet)
+        self.assertEqual(sorted(d.get_dictionary()), sorted(raw.get_dictionary()))
+        self.assertEqual(d.get_sem_types(u"insulin"), {"pharmacologic_substance":1})
+        self.assertNotIn(u"insulin", d._dictionary["disease_or_syndrome"]["MSH"])
+        # a rebuilt cache file makes the compiled store stale
+        fpath = os.path.join(self.rootdir, "pharmacologic_substance.MSH.txt.bz2")
+        os.utime(fpath, (0, os.path.getmtime(fpath) + 10))
+        self.assertIsNone(TermStore.open(self.rootdir, ignore_case=True))
+        self.assertIsNotNone(compile_dictionaries(self.rootdir, ignore_case=True))
+        self.assertIsNotNone(TermStore.open(self.rootdir, ignore_case=True))
+        shutil.rmtree(store.dirname)
+
+    def test_noise_aware_dict(self):
+        d = UmlsNoiseAwareDict(positive=["Disease or Syndrome"], negative=["Pharmacologic Substance"],
+                               rootdir=self.rootdir, n_jobs=1)
+        self.assertIsInstance(d._dictionary["disease_or_syndrome"]["MSH"], TermSet)
+        self.assertEqual(len(d.store), 4) # terms are interned after normalization
+        idset = d.store.idset("disease_or_syndrome", "MSH")
+        self.assertIn("type 1 diabetes", idset)
+        self.assertNotIn(u"insulin", idset)
+        self.assertEqual(len(d.store.term_table()), 2) # only probed terms are decoded
+        self.assertEqual(sorted(d.dictionary(min_size=0)), [u"diabetes mellitus, nos",
+                         u"type 1 diabetes"])
+        self.assertEqual(d.get_semantic_types(u"insulin"), {"pharmacologic_substance":1})
+        self.assertEqual(d.get_semantic_types(u"type 1 diabetes"), {"disease_or_syndrome":2})
+        matrix, stys = d.semantic_type_matrix([u"insulin", u"type 1 diabetes"] * 2)
+        self.assertEqual(matrix.toarray().tolist(), [[0, 1], [2, 0]] * 2)
+        lfs = {lf.__name__:lf for lf in d.lfs()}
+        self.assertEqual(sorted(lfs), ["LF_disease_or_syndrome_MSH_pos",
+                         "LF_disease_or_syndrome_SNOMEDCT_US_pos", "LF_pharmacologic_substance_MSH_neg"])
+        self.assertEqual(lfs["LF_pharmacologic_substance_MSH_neg"](Mention(u"Insulin")), -1)
+        self.assertEqual(lfs["LF_disease_or_syndrome_MSH_pos"](Mention(u"Insulin")), 0)
+
+    def test_labeler(self):
+        mentions = [Mention(t) for t in [u"Insulin", u"type 1 diabetes", u"aspirin", u"Type 1 Diabetes"]]
+        d = UmlsNoiseAwareDict(positive=["Disease or Syndrome"], negative=["Pharmacologic Substance"],
+                               rootdir=self.rootdir, rm_sab=["SNOMEDCT_US"])
+        labeler = d.labeler()
+        lfs = list(d.lfs())
+        self.assertEqual(labeler.lf_names, [lf.__name__ for lf in lfs])
+        L = labeler.apply(mentions)
+        self.assertEqual(L.toarray().tolist(), [[lf(m) for lf in lfs] for m in mentions])
+        self.assertEqual(L.nnz, 4)
+        self.assertEqual((L != labeler.apply(mentions, dedupe=False)).nnz, 0)
+        self.assertEqual((L != d.apply_lfs(mentions * 3, n_jobs=2)[-4:]).nnz, 0)
+        self.assertEqual((L != apply_lfs(mentions, lfs, n_jobs=2, chunksize=3)).nnz, 0)
+
+        d = UmlsDict("terms", rootdir=self.rootdir, ignore_case=True)
+        labeler = d.labeler(1, rvalue_map={("pharmacologic_substance","MSH"):-1}, min_size=0)
+        lfs = list(d.get_lfs(1, rvalue_map={("pharmacologic_substance","MSH"):-1}, min_size=0))
+        L = labeler.apply(mentions)
+        self.assertEqual(L.toarray().tolist(), [[lf(m) for lf in lfs] for m in mentions])
+        self.assertEqual(L[0, labeler.columns["LF_terms_pharmacologic_substance_MSH_neg"]], -1)
+
+    def test_label_store(self):
+        mentions = [Mention(t) for t in [u"Insulin", u"type 1 diabetes", u"aspirin", u"Type 1 Diabetes"]]
+        store = LabelStore(os.path.join(self.tmpdir, "labels"))
+        d = UmlsNoiseAwareDict(positive=["Disease or Syndrome"], negative=["Pharmacologic Substance"],
+                               rootdir=self.rootdir)
+        labeler = d.labeler()
+        names = ["LF_disease_or_syndrome_MSH_pos", "LF_pharmacologic_substance_MSH_neg"]
+        L = store.label_matrix(mentions[:3], labeler.subset(names), ids=[10, 11, 12])
+        self.assertEqual((L != labeler.subset(names).apply(mentions[:3])).nnz, 0)
+
+        # adding an LF and a candidate only computes the new cells
+        calls, subset = [], labeler.subset
+        labeler.subset = lambda names: calls.append(names) or subset(names)
+        store = LabelStore(os.path.join(self.tmpdir, "labels"))
+        L = store.label_matrix(mentions, labeler, ids=[10, 11, 12, 13])
+        self.assertEqual((L != labeler.apply(mentions)).nnz, 0)
+        self.assertEqual(sorted(map(sorted, calls)), [names, ["LF_disease_or_syndrome_SNOMEDCT_US_pos"]])
+        self.assertEqual(store.rows([13, 10]).tolist(), [3, 0])
+        self.assertIsInstance(store.column(names[0])[0], np.memmap)
+        L = store.label_matrix(mentions[::-1], labeler, ids=[13, 12, 11, 10])
+        self.assertEqual((L != labeler.apply(mentions[::-1])).nnz, 0)
+        self.assertEqual(len(calls), 2)
+
+        # rm_sab only drops LFs, the remaining columns are not recomputed
+        d.rm_sab = ["SNOMEDCT_US"]
+        kept = d.labeler()
+        self.assertEqual(sorted(kept.lf_names), sorted(names))
+        self.assertEqual([kept.checksum(n) for n in names], [labeler.checksum(n) for n in names])
+        self.assertEqual(len(labeler.checksum(names[0])), 40)
+        calls, subset = [], kept.subset
+        kept.subset = lambda names: calls.append(names) or subset(names)
+        L = store.label_matrix(mentions, kept, ids=[10, 11, 12, 13])
+        self.assertEqual((L != kept.apply(mentions)).nnz, 0)
+        self.assertEqual(calls, [])
+
+        # LF names are not used as file names
+        odd = DictionaryLabeler(d.store, [("LF_../a/b", ("pharmacologic_substance","MSH"), -1)])
+        L = store.label_matrix(mentions, odd, ids=[10, 11, 12, 13])
+        self.assertEqual(L.toarray().tolist(), [[-1], [0], [-1], [0]])
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, "a")))
+        self.assertIn("LF_../a/b", LabelStore(os.path.join(self.tmpdir, "labels")))
+
+
+if __name__ == '__main__':
+    unittest.main()